@@ -0,0 +1,160 @@
+import argparse
+import json
+import pathlib
+import sys
+import tempfile
+
+from src.config import Config
+from src.config import InferenceBackendType
+from src.config import SaliencyMode
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(
+      description=
+      'Time each processing stage on a generated corpus (entirely offline).')
+  parser.add_argument(
+      '--work-dir',
+      type=pathlib.Path,
+      default=None,
+      help=
+      'Directory to generate the corpus in; reused by later runs (default: a temporary directory)',
+  )
+  parser.add_argument(
+      '--images',
+      type=int,
+      default=30,
+      help='Number of images to generate (default: 30)',
+  )
+  parser.add_argument(
+      '--seed',
+      type=int,
+      default=0,
+      help='Seed for generating the corpus (default: 0)',
+  )
+  parser.add_argument(
+      '--results',
+      type=int,
+      default=5000,
+      help=
+      'Number of results for grouping, choosing, saving & loading (default: 5000)',
+  )
+  parser.add_argument(
+      '--repeat',
+      type=int,
+      default=3,
+      help='Number of times to repeat the result set stages (default: 3)',
+  )
+  parser.add_argument(
+      '--output',
+      type=pathlib.Path,
+      default=None,
+      help='File to write the timings to as JSON',
+  )
+  parser.add_argument(
+      '--compare',
+      type=pathlib.Path,
+      default=None,
+      help='JSON timings from a previous run to check for regressions',
+  )
+  parser.add_argument(
+      '--threshold',
+      type=float,
+      default=0.2,
+      help=
+      'Proportion slower a stage must be to count as a regression (default: 0.2)',
+  )
+  parser.add_argument(
+      '--minimum-ms',
+      type=float,
+      default=0.5,
+      help=
+      'Milliseconds per item slower a stage must be to count as a regression (default: 0.5)',
+  )
+  parser.add_argument(
+      '--pretrained',
+      action='store_true',
+      help=
+      'Use the pretrained model weights rather than random ones (needs the network, or a cached download)',
+  )
+  parser.add_argument(
+      '--tesser-path',
+      type=str,
+      default='',
+      help='Path to tesserdata folder; OCR is skipped without it',
+  )
+  parser.add_argument(
+      '--font-filename',
+      type=str,
+      default=None,
+      help='Font to draw crop text with (default: same as score.py)',
+  )
+  parser.add_argument(
+      '--saliency',
+      choices=[saliency_mode.value for saliency_mode in SaliencyMode],
+      default=SaliencyMode.ORB.value,
+      help='Saliency strategy to time (default: orb)',
+  )
+  parser.add_argument(
+      '--inference-backend',
+      choices=[backend.value for backend in InferenceBackendType],
+      default=InferenceBackendType.TORCH.value,
+      help='Inference backend to time (default: torch)',
+  )
+  args = parser.parse_args()
+
+  from src import benchmark
+
+  with tempfile.TemporaryDirectory() as temp_dir:
+    work_dir = args.work_dir or pathlib.Path(temp_dir)
+    input_dir = work_dir / 'input'
+    print('Generating corpus...')
+    paths = benchmark.generate_corpus(input_dir, args.images, args.seed)
+
+    with benchmark.GeocodeStub() as geocode_stub:
+      config = Config(
+          input_dir=input_dir,
+          output_dir=work_dir / 'output',
+          max_images=None,
+          minimum_score=-2,
+          output_count=100,
+          crop_width=1080,
+          crop_height=1920,
+          latlng_precision=4,
+          tesser_path=args.tesser_path,
+          ocr_coverage_threshold=0.1,
+          ocr_text_threshold=100,
+          saliency=SaliencyMode(args.saliency),
+          clip_pretrained='laion2b_s34b_b79k' if args.pretrained else None,
+          inference_backend=InferenceBackendType(args.inference_backend),
+          geocode_api=geocode_stub.api,
+          cache_path=work_dir / 'cache',
+      )
+      if args.font_filename:
+        config.font_filename = args.font_filename
+      stages = benchmark.run(config, paths, args.results, args.repeat)
+
+  data = {
+      'metadata': benchmark.get_metadata(config, len(paths), args.seed,
+                                         args.results, args.repeat),
+      'stages': stages,
+  }
+  print(benchmark.format_summary(stages))
+  if args.output:
+    with args.output.open('w') as f:
+      json.dump(data, f, indent=2)
+    print(f'Written to {args.output}')
+
+  if args.compare:
+    with args.compare.open('r') as f:
+      baseline = json.load(f)
+    regressions = benchmark.compare(baseline, data, args.threshold,
+                                    args.minimum_ms)
+    if regressions:
+      print('\n'.join(('Regressions:', *(f'  {line}' for line in regressions))))
+      sys.exit(1)
+    print('No regressions')
+
+
+if __name__ == '__main__':
+  main()
@@ -1,11 +1,16 @@
 import argparse
+import contextlib
+import os
 import pathlib
+import signal
+import sys
 
-from src import geocode_manager
-from src import result_manager
-from src import score_processor
-from src import server
+from src import import_profiler
 from src.config import Config
+from src.config import GroupMode
+from src.config import InferenceBackendType
+from src.config import ResultEncoding
+from src.config import SaliencyMode
 
 
 def main() -> None:
@@ -63,6 +68,13 @@ def main() -> None:
       help=
       'Precision to use for lat-lng reverse geocoding (4dp ~= 10m accuracy)',
   )
+  parser.add_argument(
+      '--geocode-api',
+      type=str,
+      default=None,
+      help=
+      'Reverse geocoding URL with {lat} & {lon} placeholders (default: Nominatim)',
+  )
   parser.add_argument(
       '--tesser-path',
       type=str,
@@ -81,6 +93,172 @@ def main() -> None:
       default=100,
       help='Images with OCR text count above this threshold may be excluded',
   )
+  parser.add_argument(
+      '--score-batch-size',
+      type=int,
+      default=16,
+      help='Number of images to score in each model batch (default: 16)',
+  )
+  parser.add_argument(
+      '--score-batch-wait',
+      type=float,
+      default=5,
+      help=
+      'Maximum seconds to wait for a batch to fill before scoring it (default: 5)',
+  )
+  parser.add_argument(
+      '--workers',
+      type=int,
+      default=1,
+      help='Number of worker processes to analyse images with (default: 1)',
+  )
+  parser.add_argument(
+      '--prefetch',
+      type=int,
+      default=8,
+      help='Number of images to decode ahead of analysis (default: 8)',
+  )
+  parser.add_argument(
+      '--decode-threads',
+      type=int,
+      default=4,
+      help='Number of threads to decode images with (default: 4)',
+  )
+  parser.add_argument(
+      '--orb-size',
+      type=int,
+      default=1024,
+      help=
+      'Longest side to downscale images to for finding centres (default: 1024)',
+  )
+  parser.add_argument(
+      '--saliency',
+      choices=[saliency_mode.value for saliency_mode in SaliencyMode],
+      default=SaliencyMode.ORB.value,
+      help=
+      'How to find crop centres: mean of ORB keypoints, spectral residual saliency or densest keypoint cluster (default: orb)',
+  )
+  parser.add_argument(
+      '--saliency-report',
+      action='store_true',
+      help=
+      'Also run the other saliency strategies & report how long each takes & how much they differ (default: False)',
+  )
+  parser.add_argument(
+      '--ocr-size',
+      type=int,
+      default=2048,
+      help='Longest side to downscale images to for OCR (default: 2048)',
+  )
+  parser.add_argument(
+      '--ocr-threads',
+      type=int,
+      default=2,
+      help=
+      'Number of threads to analyse images (including OCR) with (default: 2)',
+  )
+  parser.add_argument(
+      '--ocr-gate-threshold',
+      type=float,
+      default=0.01,
+      help=
+      'Skip OCR for images with a lower edge density than this; 0 to always run OCR (default: 0.01)',
+  )
+  parser.add_argument(
+      '--group-mode',
+      choices=[group_mode.value for group_mode in GroupMode],
+      default=GroupMode.TIME.value,
+      help=
+      'Group images by time taken, visual similarity or both (default: time)',
+  )
+  parser.add_argument(
+      '--similarity-threshold',
+      type=float,
+      default=0.95,
+      help=
+      'Minimum embedding similarity for images to be grouped (default: 0.95)',
+  )
+  parser.add_argument(
+      '--duplicate-distance',
+      type=int,
+      default=4,
+      help=
+      'Maximum perceptual hash distance for images to be duplicates (default: 4)',
+  )
+  parser.add_argument(
+      '--inference-backend',
+      choices=[backend.value for backend in InferenceBackendType],
+      default=InferenceBackendType.TORCH.value,
+      help='How to run the image scoring model (default: torch)',
+  )
+  parser.add_argument(
+      '--quantize',
+      action='store_true',
+      help='Use int8 dynamic quantization with the onnx/torchscript backends',
+  )
+  parser.add_argument(
+      '--result-encoding',
+      choices=[encoding.value for encoding in ResultEncoding],
+      default=ResultEncoding.JSON.value,
+      help=
+      'How to store results; compact is smaller and loads faster, json is easier to read (default: json)',
+  )
+  parser.add_argument(
+      '--cache-dir',
+      type=pathlib.Path,
+      default=None,
+      help=
+      'Directory to cache models, thumbnails and crops in (default: a directory per input directory in ~/.cache/auto-image)',
+  )
+  parser.add_argument(
+      '--image-cache-mb',
+      type=int,
+      default=512,
+      help='Most memory to use caching decoded images (default: 512)',
+  )
+  parser.add_argument(
+      '--crop-cache-mb',
+      type=int,
+      default=1024,
+      help='Most disk space to use caching rendered crops (default: 1024)',
+  )
+  parser.add_argument(
+      '--thumbnail-threads',
+      type=int,
+      default=2,
+      help=
+      'Number of threads to build thumbnails with in the background (default: 2)',
+  )
+  parser.add_argument(
+      '--render-workers',
+      type=int,
+      default=os.cpu_count() or 1,
+      help=
+      'Number of worker processes to render output crops with (default: number of CPUs)',
+  )
+  parser.add_argument(
+      '--rescore',
+      action='store_true',
+      help='Re-score all images from their stored embeddings before processing',
+  )
+  parser.add_argument(
+      '--profile',
+      action='store_true',
+      help=
+      'Profile processing & write a report (including the slowest files) into the output directory',
+  )
+  parser.add_argument(
+      '--profile-file-count',
+      type=int,
+      default=10,
+      help=
+      'Number of the slowest files per stage to report when profiling (default: 10)',
+  )
+  parser.add_argument(
+      '--import-profile',
+      action='store_true',
+      help='Report how long imports took & how much memory they used',
+  )
   parser.add_argument(
       '--serve',
       action='store_true',
@@ -88,6 +266,16 @@ def main() -> None:
   )
 
   args = parser.parse_args()
+  if args.import_profile:
+    import_profiler.install()
+
+  # These are imported here so the import profiler can see them
+  from src import geocode_manager
+  from src import metrics
+  from src import result_manager
+  from src import run_profiler
+  from src import score_processor
+
   config = Config(
       input_dir=args.input_dir,
       output_dir=args.output_dir,
@@ -97,9 +285,33 @@ def main() -> None:
       crop_width=args.crop_width,
       crop_height=args.crop_height,
       latlng_precision=args.latlng_precision,
+      geocode_api=args.geocode_api,
       tesser_path=args.tesser_path,
       ocr_coverage_threshold=args.ocr_coverage_threshold,
       ocr_text_threshold=args.ocr_text_threshold,
+      score_batch_size=args.score_batch_size,
+      score_batch_wait=args.score_batch_wait,
+      workers=args.workers,
+      prefetch=args.prefetch,
+      decode_threads=args.decode_threads,
+      orb_size=args.orb_size,
+      saliency=SaliencyMode(args.saliency),
+      saliency_report=args.saliency_report,
+      ocr_size=args.ocr_size,
+      ocr_threads=args.ocr_threads,
+      ocr_gate_threshold=args.ocr_gate_threshold,
+      group_mode=GroupMode(args.group_mode),
+      similarity_threshold=args.similarity_threshold,
+      duplicate_distance=args.duplicate_distance,
+      inference_backend=InferenceBackendType(args.inference_backend),
+      quantize=args.quantize,
+      profile_file_count=args.profile_file_count,
+      result_encoding=ResultEncoding(args.result_encoding),
+      cache_path=args.cache_dir,
+      image_cache_bytes=args.image_cache_mb * 2**20,
+      crop_cache_bytes=args.crop_cache_mb * 2**20,
+      thumbnail_threads=args.thumbnail_threads,
+      render_workers=args.render_workers,
   )
 
   config.log('Loading result set...')
@@ -109,16 +321,33 @@ def main() -> None:
   config.log('Initialising score processor...')
   scorer = score_processor.Scorer(config, result_set, geocoder)
   if args.serve:
+    from src import server
+
+    if args.import_profile:
+      import_profiler.report(config.log)
+    # Exit normally when stopped, so edits waiting to be saved are saved
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
     config.log('Starting server...')
     server.serve(config, result_set, scorer)
   else:
-    config.log('Processing...')
-    scorer.process()
-    if args.apply:
-      scorer.update_files()
+    if args.profile:
+      profile = run_profiler.Profile(config, 'score')
     else:
-      scorer.compare_files()
-      config.log('Skipped applying file changes; use --apply to apply changes')
+      profile = contextlib.nullcontext()
+    with profile:
+      if args.rescore:
+        scorer.rescore()
+      config.log('Processing...')
+      scorer.process()
+      if args.apply:
+        scorer.update_files()
+      else:
+        scorer.compare_files()
+        config.log(
+            'Skipped applying file changes; use --apply to apply changes')
+    config.log(metrics.summary())
+    if args.import_profile:
+      import_profiler.report(config.log)
 
 
 if __name__ == '__main__':
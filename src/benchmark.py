@@ -0,0 +1,397 @@
+from dataclasses import dataclass
+from dataclasses import field
+import datetime
+from http import server
+import importlib.util
+import json
+import math
+import pathlib
+import platform
+import random
+import shutil
+import statistics
+import threading
+import time
+from typing import Callable
+
+import numpy as np
+from PIL import ExifTags
+from PIL import Image
+from PIL import ImageDraw
+from PIL import ImageFilter
+
+from src import geocode_manager
+from src import image_analyzer
+from src import result_manager
+from src import score_processor
+from src.config import Config
+
+# Megapixels of the generated images (cycled through)
+CORPUS_MEGAPIXELS = (2, 8, 12)
+# Every Nth image is mostly text (like a screenshot or photo of a document)
+TEXT_EVERY = 5
+CORPUS_START = datetime.datetime(2024, 6, 1, 9, 0, 0)
+# (lat, lon) of the places images are "taken" around
+CORPUS_PLACES = (
+    (51.6369, -0.5001),
+    (48.8584, 2.2945),
+    (40.6892, -74.0445),
+    (-33.8568, 151.2153),
+)
+CORPUS_WORDS = ('receipt', 'total', 'invoice', 'amount', 'date', 'meeting',
+                'notes', 'agenda', 'screen', 'settings', 'battery', 'update')
+CORPUS_MANIFEST = '_benchmark_corpus.json'
+
+# The state files processing creates; they're removed so every run starts from
+# the same (empty) state
+STATE_GLOBS = (
+    '_auto_image*.json',
+    '_auto_image*.json.migrated',
+    '_auto_image*.npy',
+    '_auto_image*.log',
+    '_auto_image.db*',
+)
+
+STUB_RESPONSE = {
+    'display_name': 'Benchmark Town, Benchmarkshire, United Kingdom',
+    'address': {
+        'village': 'Benchmark Town',
+        'state': 'Benchmarkshire',
+        'country': 'United Kingdom',
+        'country_code': 'gb',
+    },
+}
+
+
+def _to_dms(value: float) -> tuple[float, float, float]:
+  value = abs(value)
+  degrees = int(value)
+  minutes = int((value - degrees) * 60)
+  seconds = round((value - degrees - minutes / 60) * 3600, 2)
+  return (float(degrees), float(minutes), seconds)
+
+
+def _make_gps(lat: float, lon: float) -> dict[int, object]:
+  return {
+      ExifTags.GPS.GPSLatitudeRef: 'N' if lat >= 0 else 'S',
+      ExifTags.GPS.GPSLatitude: _to_dms(lat),
+      ExifTags.GPS.GPSLongitudeRef: 'E' if lon >= 0 else 'W',
+      ExifTags.GPS.GPSLongitude: _to_dms(lon),
+      ExifTags.GPS.GPSAltitudeRef: 0,
+      ExifTags.GPS.GPSAltitude: 100.0,
+  }
+
+
+def _make_photo(rng: random.Random, size: tuple[int, int]) -> Image.Image:
+  # Smooth colour variation (upscaled noise) with a few shapes on it, which is
+  # close enough to a photo for decoding, cropping & keypoints
+  np_rng = np.random.default_rng(rng.randrange(2**32))
+  noise = np_rng.integers(0, 256, (6, 8, 3), dtype=np.uint8)
+  image = Image.fromarray(noise).resize(size, Image.Resampling.BICUBIC)
+  draw = ImageDraw.Draw(image)
+  scale = min(size)
+  for _ in range(rng.randint(3, 8)):
+    x = rng.randrange(size[0])
+    y = rng.randrange(size[1])
+    radius = rng.randint(scale // 20, scale // 5)
+    colour = tuple(rng.randrange(256) for _ in range(3))
+    shape = draw.ellipse if rng.random() < 0.5 else draw.rectangle
+    shape((x - radius, y - radius, x + radius, y + radius), fill=colour)
+  return image.filter(ImageFilter.GaussianBlur(scale / 500))
+
+
+def _make_text(rng: random.Random, size: tuple[int, int]) -> Image.Image:
+  image = Image.new('RGB', size, (245, 245, 240))
+  draw = ImageDraw.Draw(image)
+  line_height = max(size[1] // 40, 12)
+  for y in range(line_height, size[1] - line_height, line_height * 2):
+    words = ' '.join(rng.choice(CORPUS_WORDS) for _ in range(12))
+    draw.text((line_height, y), words, fill=(20, 20, 20), font_size=line_height)
+  return image
+
+
+def generate_corpus(directory: pathlib.Path, count: int,
+                    seed: int) -> list[pathlib.Path]:
+  # Makes the same images (names, pixels & EXIF) for the same count & seed, so
+  # results can be compared between runs; existing images are reused
+  manifest_path = directory / CORPUS_MANIFEST
+  manifest = {'count': count, 'seed': seed}
+  if manifest_path.exists():
+    with manifest_path.open('r') as f:
+      if json.load(f) == manifest:
+        return sorted(directory.glob('*.jpg'))
+
+  directory.mkdir(parents=True, exist_ok=True)
+  for path in directory.glob('*.jpg'):
+    path.unlink()
+
+  rng = random.Random(seed)
+  taken = CORPUS_START
+  paths = []
+  for index in range(count):
+    megapixels = CORPUS_MEGAPIXELS[index % len(CORPUS_MEGAPIXELS)]
+    width = int(math.sqrt(megapixels * 1e6 * 4 / 3))
+    size = (width, width * 3 // 4)
+    if rng.random() < 0.3:
+      # Portrait
+      size = (size[1], size[0])
+
+    # Some images are taken in quick succession (so get grouped)
+    if rng.random() < 0.3:
+      taken += datetime.timedelta(seconds=rng.randint(1, 5))
+    else:
+      taken += datetime.timedelta(minutes=rng.randint(5, 600))
+
+    if index % TEXT_EVERY == TEXT_EVERY - 1:
+      image = _make_text(rng, size)
+    else:
+      image = _make_photo(rng, size)
+
+    exif = Image.Exif()
+    lat, lon = rng.choice(CORPUS_PLACES)
+    exif[ExifTags.IFD.GPSInfo] = _make_gps(lat + rng.uniform(-0.01, 0.01),
+                                           lon + rng.uniform(-0.01, 0.01))
+    path = directory / f'{taken:%Y-%m-%d %H.%M.%S}.jpg'
+    image.save(path, quality=90, exif=exif)
+    paths.append(path)
+
+  with manifest_path.open('w') as f:
+    json.dump(manifest, f)
+  return paths
+
+
+class _StubHandler(server.BaseHTTPRequestHandler):
+
+  def do_GET(self):
+    body = json.dumps(STUB_RESPONSE).encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+class GeocodeStub:
+  # A local stand in for Nominatim so benchmarks never touch the network
+
+  def __enter__(self) -> 'GeocodeStub':
+    self._server = server.ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+    self._thread = threading.Thread(target=self._server.serve_forever,
+                                    daemon=True)
+    self._thread.start()
+    return self
+
+  def __exit__(self, *args) -> None:
+    self._server.shutdown()
+    self._server.server_close()
+
+  @property
+  def api(self) -> str:
+    port = self._server.server_address[1]
+    return f'http://127.0.0.1:{port}/reverse?format=jsonv2&lat={{lat}}&lon={{lon}}'
+
+
+@dataclass
+class StageTimer:
+  durations: dict[str, list[float]] = field(default_factory=dict)
+  items: dict[str, int] = field(default_factory=dict)
+
+  def time(self, stage: str, func: Callable, *args, items: int = 1, **kwargs):
+    start_time = time.perf_counter()
+    value = func(*args, **kwargs)
+    self.durations.setdefault(stage,
+                              []).append(time.perf_counter() - start_time)
+    self.items[stage] = self.items.get(stage, 0) + items
+    return value
+
+  def summary(self) -> dict[str, dict[str, float]]:
+    stages = {}
+    for stage, durations in self.durations.items():
+      ordered = sorted(durations)
+      stages[stage] = {
+          'calls': len(durations),
+          'items': self.items[stage],
+          'total_ms': 1000 * sum(durations),
+          'per_item_ms': 1000 * sum(durations) / self.items[stage],
+          'p50_ms': 1000 * statistics.median(ordered),
+          'p95_ms': 1000 * ordered[min(int(len(ordered) * 0.95),
+                                       len(ordered) - 1)],
+      }
+    return stages
+
+
+def _add_synthetic_results(result_set: result_manager.ResultSet,
+                           count: int) -> None:
+  # Copies the real results (with new names) so the whole-set stages can be
+  # measured at a realistic library size
+  templates = list(result_set.results.values())
+  if not templates:
+    return
+  rng = random.Random(len(templates))
+  for index in range(count - len(templates)):
+    template = templates[index % len(templates)]
+    taken = CORPUS_START + datetime.timedelta(minutes=7 * index)
+    data = template.to_dict()
+    data['file_id'] = f'{taken:%Y-%m-%d %H.%M.%S}-synthetic.jpg'
+    data['path'] = None
+    data['phash'] = f'{rng.getrandbits(64):016x}'
+    data['taken'] = taken.isoformat()
+    result = result_manager.Result.from_dict(data, result_set.config)
+    result_set.add(result)
+
+
+def run(config: Config, paths: list[pathlib.Path], result_count: int,
+        repeat: int) -> dict[str, dict[str, float]]:
+  for glob in STATE_GLOBS:
+    for path in config.input_dir.glob(glob):
+      path.unlink()
+  result_manager.IMAGE_CACHE.clear()
+  # Crops & thumbnails are cached on disk, so previous runs' would all be hits
+  for cache_name in ('crops', 'thumbnails'):
+    shutil.rmtree(config.cache_dir / cache_name, ignore_errors=True)
+
+  timer = StageTimer()
+  result_set = result_manager.ResultSet(config)
+  geocoder = geocode_manager.GeoCoder(config)
+  scorer = score_processor.Scorer(config, result_set, geocoder)
+  analyzer = scorer.analyzer
+
+  run_ocr = bool(config.tesser_path)
+  if run_ocr:
+    if importlib.util.find_spec('tesserocr') is None:
+      config.log('tesserocr is not installed; skipping OCR')
+      run_ocr = False
+
+  # Per-image stages
+  config.log(f'Timing per-image stages for {len(paths)} images...')
+  analyses = []
+  for path in paths:
+    timer.time('load_image', result_manager.load_image, path)
+    result_manager.IMAGE_CACHE.clear()
+
+    task = image_analyzer.AnalysisTask(
+        path=path,
+        needs_centre=True,
+        needs_lat_lon=True,
+        needs_ocr=run_ocr,
+        needs_scores=True,
+        needs_phash=True,
+        needs_thumbnails=True,
+    )
+    analysis = image_analyzer.Analysis(task=task)
+    image = timer.time('load_analysis_image', analyzer.load, analysis)
+    analysis.centre, _, _ = timer.time(
+        'centre',
+        analyzer.saliency_engine.find_centre,
+        np.asarray(image.orb),
+        image.original_size,
+    )
+    analysis.lat_lon = timer.time(
+        'extract_lat_lon',
+        geocode_manager.GeoCoder.extract_lat_lon,
+        image.exif,
+    )
+    analysis.lat_lon_extracted = True
+    if analysis.lat_lon:
+      timer.time('geocode', geocoder.get_name, analysis.lat_lon)
+    analysis.phash = timer.time('phash', image_analyzer.get_dhash, image.orb)
+    if run_ocr:
+      timer.time('ocr', analyzer._ocr, analysis, image)
+    timer.time('thumbnails', analyzer.thumbnails.build, path, image.decoded)
+    analyses.append((analysis, image))
+
+  # Load the model before timing so that isn't included in the first batch
+  analyzer._init_model()
+  batch_size = config.score_batch_size
+  for start in range(0, len(analyses), batch_size):
+    batch = analyses[start:start + batch_size]
+    timer.time('score', analyzer.score_analyses, batch, items=len(batch))
+  analyzer.end()
+
+  for analysis, _ in analyses:
+    result_set.get_result(analysis.task.path.name).path = analysis.task.path
+  scorer._merge_analyses([analysis for analysis, _ in analyses])
+
+  # Crops (with the source image already loaded, so only cropping is timed)
+  config.log('Timing crops...')
+  for result in list(result_set.results.values()):
+    result.get_image((config.crop_width, config.crop_height))
+    timer.time('get_cropped', result.get_cropped, config)
+    timer.time('get_cropped_bytes', result.get_cropped_bytes, config)
+    timer.time('crop_cache_miss', scorer.crop_cache.get_path, result)
+    timer.time('crop_cache_hit', scorer.crop_cache.get_bytes, result)
+    result_manager.IMAGE_CACHE.clear()
+
+  # Whole result set stages
+  _add_synthetic_results(result_set, result_count)
+  config.log(
+      f'Timing result set stages for {len(result_set.results)} results...')
+  for _ in range(repeat):
+    timer.time('find_groups', scorer.find_groups, items=len(result_set.results))
+    timer.time('update_chosen',
+               scorer.update_chosen,
+               items=len(result_set.results))
+    timer.time('result_set_save',
+               result_set.save,
+               items=len(result_set.results))
+    loaded = timer.time('result_set_load',
+                        result_manager.ResultSet,
+                        config,
+                        items=len(result_set.results))
+    # Each load opens its own connection to the database
+    loaded._connection.close()
+
+  return timer.summary()
+
+
+def compare(baseline: dict, current: dict, threshold: float,
+            minimum_ms: float) -> list[str]:
+  # A stage has regressed if it's slower per item by more than the threshold
+  # (& by more than a minimum, so tiny stages don't flag on noise)
+  regressions = []
+  for stage, current_stage in current['stages'].items():
+    baseline_stage = baseline['stages'].get(stage)
+    if not baseline_stage:
+      continue
+    before = baseline_stage['per_item_ms']
+    after = current_stage['per_item_ms']
+    if after > before * (1 + threshold) and after - before > minimum_ms:
+      regressions.append(
+          f'{stage}: {before:.03f}ms -> {after:.03f}ms per item ({100 * (after / before - 1):+.01f}%)'
+      )
+  return regressions
+
+
+def get_metadata(config: Config, image_count: int, seed: int, result_count: int,
+                 repeat: int) -> dict:
+  return {
+      'time': datetime.datetime.now().isoformat(timespec='seconds'),
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'images': image_count,
+      'seed': seed,
+      'results': result_count,
+      'repeat': repeat,
+      'pretrained': config.clip_pretrained,
+      'inference_backend': config.inference_backend.value,
+      'saliency': config.saliency.value,
+      'ocr': bool(config.tesser_path),
+  }
+
+
+def format_summary(stages: dict[str, dict[str, float]]) -> str:
+  lines = [
+      f'  {"Stage":<20} {"Items":>7} {"Per item":>11} {"p50":>11} {"p95":>11}'
+  ]
+  for stage, summary in stages.items():
+    lines.append(' '.join((
+        f'  {stage:<20}',
+        f'{summary["items"]:>7}',
+        f'{summary["per_item_ms"]:>9.03f}ms',
+        f'{summary["p50_ms"]:>9.03f}ms',
+        f'{summary["p95_ms"]:>9.03f}ms',
+    )))
+  return '\n'.join(lines)
@@ -1,8 +1,35 @@
 import dataclasses
+from enum import Enum
+import hashlib
+import os
 import pathlib
-from typing import Callable, Optional
+from typing import Callable, Optional, TYPE_CHECKING
 
-from PIL import ImageFont
+if TYPE_CHECKING:
+  from PIL import ImageFont
+
+
+class GroupMode(Enum):
+  TIME = 'time'
+  SIMILARITY = 'similarity'
+  BOTH = 'both'
+
+
+class InferenceBackendType(Enum):
+  TORCH = 'torch'
+  TORCHSCRIPT = 'torchscript'
+  ONNX = 'onnx'
+
+
+class SaliencyMode(Enum):
+  ORB = 'orb'
+  SPECTRAL = 'spectral'
+  DENSITY = 'density'
+
+
+class ResultEncoding(Enum):
+  JSON = 'json'
+  COMPACT = 'compact'
 
 
 @dataclasses.dataclass
@@ -18,6 +45,50 @@ class Config:
   tesser_path: str
   ocr_coverage_threshold: float
   ocr_text_threshold: int
+  score_batch_size: int = 16
+  score_batch_wait: float = 5
+  workers: int = 1
+  prefetch: int = 8
+  decode_threads: int = 4
+  orb_size: int = 1024
+  saliency: SaliencyMode = SaliencyMode.ORB
+  saliency_report: bool = False
+  ocr_size: int = 2048
+  ocr_threads: int = 2
+  ocr_gate_threshold: float = 0.01
+  clip_size: int = 224
+  group_mode: GroupMode = GroupMode.TIME
+  similarity_threshold: float = 0.95
+  duplicate_distance: int = 4
+  # None uses random weights (only useful for benchmarking)
+  clip_pretrained: Optional[str] = 'laion2b_s34b_b79k'
+  inference_backend: InferenceBackendType = InferenceBackendType.TORCH
+  quantize: bool = False
+  backend_tolerance: float = 0.01
+  # Reverse geocoding URL (with {lat} & {lon} placeholders); None uses Nominatim
+  geocode_api: Optional[str] = None
+  # Number of the slowest files (per stage) to include in profile reports
+  profile_file_count: int = 10
+  # Seconds to wait for edits to stop before saving them, & the longest any
+  # edit waits to be saved
+  save_delay: float = 1
+  save_max_latency: float = 5
+  # Where models, thumbnails & crops are cached; None uses a directory (per
+  # input directory) in the user's cache directory, so caches aren't synced
+  # along with the input directory
+  cache_path: Optional[pathlib.Path] = None
+  # Most memory used by decoded images which are cached (for cropping)
+  image_cache_bytes: int = 512 * 2**20
+  # Most disk space to use for rendered crops (in cache_dir)
+  crop_cache_bytes: int = 1024 * 2**20
+  # Threads building thumbnails in the background
+  thumbnail_threads: int = 2
+  # Worker processes rendering output crops
+  render_workers: int = os.cpu_count() or 1
+  # How results are serialised in the database; compact (a JSON list of values
+  # without the keys) is smaller & quicker to load (either can be read whatever
+  # this is set to)
+  result_encoding: ResultEncoding = ResultEncoding.JSON
 
   log: Callable[[str], None] = print
 
@@ -33,7 +104,19 @@ class Config:
   output_quality: int = 95
 
   @property
-  def font(self) -> ImageFont.FreeTypeFont:
+  def cache_dir(self) -> pathlib.Path:
+    if self.cache_path:
+      return self.cache_path
+    cache_home = pathlib.Path(
+        os.environ.get('XDG_CACHE_HOME') or pathlib.Path.home() / '.cache')
+    input_key = hashlib.sha256(str(
+        self.input_dir.absolute()).encode()).hexdigest()[:16]
+    return cache_home / 'auto-image' / input_key
+
+  @property
+  def font(self) -> 'ImageFont.FreeTypeFont':
+    from PIL import ImageFont
+
     if not hasattr(self, '_font'):
       self._font = ImageFont.truetype(self.font_filename, self.font_size)
     return self._font
@@ -0,0 +1,186 @@
+import collections
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+import threading
+import time
+from typing import Optional
+
+from PIL import Image
+
+from src import metrics
+from src import result_manager
+from src.config import Config
+
+# Format crops are served in
+SERVE_FORMAT = 'JPEG'
+
+TEMP_SUFFIX = '.tmp'
+
+# Set in worker processes by init_worker
+_WORKER_CONFIG: Optional[Config] = None
+
+
+def get_format(path: pathlib.Path) -> str:
+  image_format = Image.registered_extensions().get(path.suffix.lower())
+  if not image_format:
+    raise Exception(f'Unknown image format: {path}')
+  return image_format
+
+
+def render(config: Config, result: result_manager.Result, image_format: str,
+           path: pathlib.Path) -> float:
+  # Written to a temp file & renamed so the crop is never seen half written;
+  # returns how long it took
+  start_time = time.perf_counter()
+  cropped = result.get_cropped(config)
+  with tempfile.NamedTemporaryFile(dir=path.parent,
+                                   suffix=TEMP_SUFFIX,
+                                   delete=False) as temp_file:
+    cropped.save(temp_file, image_format, quality=config.output_quality)
+  os.replace(temp_file.name, path)
+  return time.perf_counter() - start_time
+
+
+def init_worker(config: Config) -> None:
+  global _WORKER_CONFIG
+  _WORKER_CONFIG = config
+  # Each image is only cropped once, so caching decoded images is a waste
+  result_manager.IMAGE_CACHE.set_max_bytes(0)
+
+
+def render_in_worker(result: result_manager.Result, image_format: str,
+                     path: pathlib.Path) -> float:
+  return render(_WORKER_CONFIG, result, image_format, path)
+
+
+class CropCache:
+  # Rendered crops on disk, named by a hash of everything which affects their
+  # pixels, so they survive restarts & a crop previewed in the server is reused
+  # when applying. The least recently used are removed to stay under the limit.
+
+  def __init__(self, config: Config):
+    self.config = config
+    self.directory = config.cache_dir / 'crops'
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._lock = threading.Lock()
+    # Size of each file, least recently used first
+    self._sizes: collections.OrderedDict[str, int] = collections.OrderedDict()
+    self._total_bytes = 0
+    self._load()
+    metrics.register_collector(self._get_metrics)
+
+  def _load(self) -> None:
+    self.directory.mkdir(parents=True, exist_ok=True)
+    entries = []
+    for entry in os.scandir(self.directory):
+      if entry.name.endswith(TEMP_SUFFIX):
+        # Left behind by a render which didn't finish
+        os.unlink(entry.path)
+        continue
+      stat = entry.stat()
+      entries.append((stat.st_mtime, entry.name, stat.st_size))
+    # Files are touched when used, so the oldest were used least recently
+    for _, name, size in sorted(entries):
+      self._sizes[name] = size
+      self._total_bytes += size
+
+  def get_key(self, result: result_manager.Result, image_format: str) -> str:
+    if not result.path:
+      raise Exception(f'Can\'t crop when path is not set! {result.file_id}')
+    config = self.config
+    key_data = (
+        # Source file
+        result_manager.get_source_key(result.path),
+        # Crop
+        result.centre,
+        config.crop_width,
+        config.crop_height,
+        # Text
+        result.description or result.location,
+        result.get_time_taken_text(config),
+        config.font_filename,
+        config.font_size,
+        config.font_colour,
+        config.font_outline_width,
+        config.font_outline_colour,
+        config.text_offset_x,
+        config.text_offset_y,
+        # Encoding
+        image_format,
+        config.output_quality,
+    )
+    return hashlib.sha256(json.dumps(key_data).encode()).hexdigest()
+
+  def lookup(
+      self,
+      result: result_manager.Result,
+      image_format: str = SERVE_FORMAT,
+  ) -> tuple[pathlib.Path, bool]:
+    # Where the crop is (or should be rendered to) & whether it's cached
+    name = f'{self.get_key(result, image_format)}.{image_format.lower()}'
+    path = self.directory / name
+    with self._lock:
+      if name in self._sizes:
+        try:
+          # Keeps the order for next time this is loaded
+          os.utime(path)
+        except OSError:
+          # Evicted by another process sharing the cache (e.g. the server &
+          # --apply), so it's re-rendered
+          self._total_bytes -= self._sizes.pop(name)
+        else:
+          self.hits += 1
+          self._sizes.move_to_end(name)
+          return path, True
+      self.misses += 1
+    return path, False
+
+  def add(self, path: pathlib.Path) -> None:
+    # Records a crop rendered to a path from lookup (possibly by another
+    # process)
+    with self._lock:
+      if path.name not in self._sizes:
+        size = path.stat().st_size
+        self._sizes[path.name] = size
+        self._total_bytes += size
+        self._evict()
+
+  def get_path(self,
+               result: result_manager.Result,
+               image_format: str = SERVE_FORMAT) -> pathlib.Path:
+    # Renders the crop if it isn't already cached
+    path, cached = self.lookup(result, image_format)
+    if not cached:
+      # Rendered without the lock so other crops can be rendered at the same
+      # time
+      metrics.observe('crop_render',
+                      render(self.config, result, image_format, path))
+      self.add(path)
+    return path
+
+  def get_bytes(self, result: result_manager.Result) -> bytes:
+    return self.get_path(result).read_bytes()
+
+  def _evict(self) -> None:
+    # Always keeps the newest file, even if it's over the limit on its own
+    while self._total_bytes > self.config.crop_cache_bytes and len(
+        self._sizes) > 1:
+      name, size = self._sizes.popitem(last=False)
+      self._total_bytes -= size
+      self.evictions += 1
+      try:
+        os.unlink(self.directory / name)
+      except FileNotFoundError:
+        pass
+
+  def _get_metrics(self) -> dict[str, float]:
+    return {
+        'crop_cache_hits': self.hits,
+        'crop_cache_misses': self.misses,
+        'crop_cache_evictions': self.evictions,
+    }
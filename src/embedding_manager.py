@@ -0,0 +1,166 @@
+import base64
+import json
+import os
+import tempfile
+from typing import Optional
+
+import numpy as np
+
+from src.config import Config
+
+# Rows are stored as float16 to halve the size; they're normalised so the loss
+# of precision makes no practical difference to similarities
+DTYPE = np.float16
+
+# Limits how much float32 working memory is needed when scoring all rows
+CHUNK_SIZE = 16384
+
+
+class EmbeddingStore:
+  # Keeps the (normalised) image embedding for every scored file so they can be
+  # re-scored against different labels without touching the original images.
+  # Embeddings are in a memory mapped .npy matrix with a JSON list of file_ids.
+  # Saving only appends new embeddings to a log (as rewriting the matrix every
+  # few seconds during a big scan writes far too much); compact() merges the
+  # log into the matrix.
+
+  def __init__(self, config: Config):
+    self.config = config
+    self.matrix_path = self.config.input_dir / '_auto_image_embeddings.npy'
+    self.index_path = self.config.input_dir / '_auto_image_embeddings.json'
+    self.log_path = self.config.input_dir / '_auto_image_embeddings.log'
+
+    self._file_ids: list[str] = []
+    self._row_by_file_id: dict[str, int] = {}
+    self._matrix: Optional[np.ndarray] = None
+    # Embeddings added/changed since the matrix was last written
+    self._pending: dict[str, np.ndarray] = {}
+    # Pending embeddings which haven't been appended to the log yet
+    self._unlogged: set[str] = set()
+
+    if self.matrix_path.exists() and self.index_path.exists():
+      with self.index_path.open('r') as f:
+        self._file_ids = json.load(f)
+      self._row_by_file_id = {
+          file_id: row for row, file_id in enumerate(self._file_ids)
+      }
+      self._matrix = np.load(self.matrix_path, mmap_mode='r')
+    if self.log_path.exists():
+      self._read_log()
+
+  def _read_log(self) -> None:
+    with self.log_path.open('r') as f:
+      for line in f:
+        if not line.strip():
+          continue
+        try:
+          file_id, data = json.loads(line)
+        except ValueError:
+          # Half written when saving was interrupted
+          continue
+        # Later lines are newer, so replace earlier ones
+        self._pending[file_id] = np.frombuffer(base64.b64decode(data),
+                                               dtype=DTYPE)
+
+  def __len__(self) -> int:
+    return len(self._row_by_file_id) + len(self._pending.keys() -
+                                           self._row_by_file_id.keys())
+
+  def has(self, file_id: str) -> bool:
+    return file_id in self._pending or file_id in self._row_by_file_id
+
+  def get(self, file_id: str) -> Optional[np.ndarray]:
+    if file_id in self._pending:
+      return self._pending[file_id]
+    if (row := self._row_by_file_id.get(file_id)) is not None:
+      return self._matrix[row]
+    return None
+
+  def set(self, file_id: str, embedding: np.ndarray) -> None:
+    self._pending[file_id] = embedding.astype(DTYPE)
+    self._unlogged.add(file_id)
+
+  def get_all(self) -> tuple[list[str], np.ndarray]:
+    if not self._pending:
+      if self._matrix is None:
+        return [], np.zeros((0, 0), dtype=DTYPE)
+      return self._file_ids, self._matrix
+
+    file_ids = list(self._file_ids)
+    rows = []
+    if self._matrix is not None:
+      rows.append(np.asarray(self._matrix))
+    new_embeddings = []
+    for file_id, embedding in self._pending.items():
+      if (row := self._row_by_file_id.get(file_id)) is not None:
+        if not rows[0].flags.writeable:
+          rows[0] = rows[0].copy()
+        rows[0][row] = embedding
+      else:
+        file_ids.append(file_id)
+        new_embeddings.append(embedding)
+    if new_embeddings:
+      rows.append(np.stack(new_embeddings))
+    return file_ids, np.concatenate(rows)
+
+  def save(self) -> None:
+    if not self._unlogged:
+      return
+    lines = [
+        json.dumps([
+            file_id,
+            base64.b64encode(self._pending[file_id].tobytes()).decode('ascii'),
+        ]) + '\n' for file_id in self._unlogged
+    ]
+    with self.log_path.open('a') as f:
+      # Starts on a new line in case the last save was interrupted part way
+      # through a line
+      f.write('\n')
+      f.writelines(lines)
+    self._unlogged = set()
+
+  def compact(self) -> None:
+    # Rewrites the matrix with everything in the log, then removes the log
+    if not self._pending:
+      return
+
+    file_ids, matrix = self.get_all()
+    with tempfile.NamedTemporaryFile(suffix='.npy',
+                                     dir=self.matrix_path.parent,
+                                     delete=False) as temp_file:
+      np.save(temp_file, matrix)
+    # Release the memory map before replacing the file underneath it
+    self._matrix = None
+    os.replace(temp_file.name, self.matrix_path)
+    with tempfile.NamedTemporaryFile(mode='w',
+                                     dir=self.index_path.parent,
+                                     delete=False) as temp_file:
+      json.dump(file_ids, temp_file)
+    os.replace(temp_file.name, self.index_path)
+
+    self._file_ids = file_ids
+    self._row_by_file_id = {
+        file_id: row for row, file_id in enumerate(file_ids)
+    }
+    self._matrix = np.load(self.matrix_path, mmap_mode='r')
+    self._pending = {}
+    self._unlogged = set()
+    self.log_path.unlink(missing_ok=True)
+
+  def score(self, labels: list[str],
+            text_features: np.ndarray) -> dict[str, dict[str, float]]:
+    # Same as the model's scoring (softmax of scaled cosine similarity) but for
+    # every stored embedding at once
+    file_ids, matrix = self.get_all()
+    text_features = text_features.astype(np.float32)
+    scores_by_file_id = {}
+    for start in range(0, len(file_ids), CHUNK_SIZE):
+      chunk = matrix[start:start + CHUNK_SIZE].astype(np.float32)
+      logits = 100.0 * chunk @ text_features.T
+      logits -= logits.max(axis=1, keepdims=True)
+      probs = np.exp(logits)
+      probs /= probs.sum(axis=1, keepdims=True)
+      for file_id, row in zip(file_ids[start:start + CHUNK_SIZE],
+                              probs.tolist()):
+        scores_by_file_id[file_id] = dict(zip(labels, row))
+    return scores_by_file_id
@@ -12,6 +12,7 @@ from PIL import ExifTags
 from PIL import Image
 import requests
 
+from src import metrics
 from src import result_manager
 from src.config import Config
 
@@ -128,6 +129,8 @@ class GeoCoder:
     self.path = self.config.input_dir / '_auto_image_geocoding.json'
     self.next_request = datetime.datetime.now()
     self.results: dict[tuple[float, float], GeoCodeResult] = {}
+    # Whether there are results which haven't been saved yet
+    self._dirty = False
     if self.path.exists():
       with self.path.open('r') as f:
         data = json.load(f)
@@ -136,15 +139,28 @@ class GeoCoder:
         self.results[(result.lat, result.lon)] = result
 
   def save(self) -> None:
-    data = [dataclasses.asdict(result) for result in self.results.values()]
-    with tempfile.NamedTemporaryFile(mode='w', delete=False) as temp_file:
-      json.dump(data, temp_file, indent=2, ensure_ascii=False)
-    os.replace(temp_file.name, self.path)
-
-  def extract_lat_lon(self,
-                      image: Image.Image) -> Optional[result_manager.LatLon]:
-    # Extract the tags
-    exifdata = image.getexif()
+    if not self._dirty:
+      return
+    # Cleared first so any results added while saving are saved next time
+    self._dirty = False
+    try:
+      data = [
+          dataclasses.asdict(result) for result in list(self.results.values())
+      ]
+      # Written next to the cache, as renaming across devices fails
+      with tempfile.NamedTemporaryFile(mode='w',
+                                       dir=self.path.parent,
+                                       prefix=self.path.name,
+                                       suffix='.json',
+                                       delete=False) as temp_file:
+        json.dump(data, temp_file, indent=2, ensure_ascii=False)
+      os.replace(temp_file.name, self.path)
+    except Exception:
+      self._dirty = True
+      raise
+
+  @staticmethod
+  def extract_lat_lon(exifdata: Image.Exif) -> Optional[result_manager.LatLon]:
     if not exifdata:
       return None
 
@@ -166,19 +182,25 @@ class GeoCoder:
 
     key = (lat_dp, lon_dp)
     if key not in self.results:
+      metrics.increment('geocode_requests', source='network')
       # Make sure we're not making too many requests
       wait_time = (self.next_request - datetime.datetime.now()).total_seconds()
       if wait_time > 0:
-        time.sleep(wait_time)
+        with metrics.timer('geocode_wait'):
+          time.sleep(wait_time)
 
-      url = API.format(lat=lat_dp, lon=lon_dp)
-      response = requests.get(url, headers=HEADERS)
-      response.raise_for_status()
-      data = response.json()
+      url = (self.config.geocode_api or API).format(lat=lat_dp, lon=lon_dp)
+      with metrics.timer('geocode_request'):
+        response = requests.get(url, headers=HEADERS)
+        response.raise_for_status()
+        data = response.json()
 
       self.results[key] = GeoCodeResult(
           lat=lat_dp,
           lon=lon_dp,
           data=data,
       )
+      self._dirty = True
+    else:
+      metrics.increment('geocode_requests', source='cache')
     return self.results[key].get_name(self.config)
@@ -0,0 +1,149 @@
+import numpy as np
+
+# Random hyperplane LSH settings; more tables find more of the similar pairs,
+# more bits make buckets smaller (so fewer similarities need calculating)
+LSH_TABLES = 12
+LSH_BITS = 14
+LSH_SEED = 0
+# Rows of a bucket compared at once, which limits the memory big buckets need
+SIMILARITY_CHUNK_SIZE = 1024
+
+# Hashes with fewer bits set (or unset) than this come from dark, flat or
+# featureless images; they all look the same, so aren't used to find duplicates
+MIN_HASH_DETAIL_BITS = 8
+# Band buckets bigger than this are ignored (real duplicates almost always
+# share a smaller bucket in another band)
+MAX_HASH_BUCKET_SIZE = 64
+
+
+class UnionFind:
+
+  def __init__(self, size: int):
+    self.parents = list(range(size))
+
+  def find(self, index: int) -> int:
+    root = index
+    while self.parents[root] != root:
+      root = self.parents[root]
+    # Compress the path so later finds are quicker
+    while self.parents[index] != root:
+      self.parents[index], index = root, self.parents[index]
+    return root
+
+  def union(self, index_a: int, index_b: int) -> None:
+    root_a = self.find(index_a)
+    root_b = self.find(index_b)
+    if root_a != root_b:
+      # Always keep the lowest index as the root so groups are stable
+      self.parents[max(root_a, root_b)] = min(root_a, root_b)
+
+  def groups(self) -> list[list[int]]:
+    # Returns all groups with more than one member, ordered by their first member
+    members_by_root: dict[int, list[int]] = {}
+    for index in range(len(self.parents)):
+      members_by_root.setdefault(self.find(index), []).append(index)
+    return [
+        members for _, members in sorted(members_by_root.items())
+        if len(members) > 1
+    ]
+
+
+def find_similar_pairs(matrix: np.ndarray,
+                       threshold: float) -> set[tuple[int, int]]:
+  # Finds all pairs of (normalised) rows with cosine similarity >= threshold.
+  # Rather than comparing every row with every other row, rows are hashed by
+  # which side of random hyperplanes they fall; similar rows almost always share
+  # a bucket in at least one table, so only rows in a bucket are compared.
+  pairs: set[tuple[int, int]] = set()
+  if len(matrix) < 2:
+    return pairs
+
+  matrix = np.asarray(matrix, dtype=np.float32)
+  # CLIP embeddings all point in roughly the same direction, so hyperplanes
+  # through the origin would put most rows in a few huge buckets; hashing the
+  # centred rows spreads them out (similarities still use the original rows)
+  centred = matrix - matrix.mean(axis=0)
+  rng = np.random.default_rng(LSH_SEED)
+  bit_values = 1 << np.arange(LSH_BITS, dtype=np.int64)
+  for _ in range(LSH_TABLES):
+    planes = rng.standard_normal((matrix.shape[1], LSH_BITS)).astype(np.float32)
+    codes = ((centred @ planes) > 0).astype(np.int64) @ bit_values
+
+    order = np.argsort(codes, kind='stable')
+    boundaries = np.flatnonzero(np.diff(codes[order])) + 1
+    for bucket in np.split(order, boundaries):
+      if len(bucket) < 2:
+        continue
+      bucket_matrix = matrix[bucket]
+      for start in range(0, len(bucket), SIMILARITY_CHUNK_SIZE):
+        # Only compares with later rows, so each pair is compared once
+        similarities = (bucket_matrix[start:start + SIMILARITY_CHUNK_SIZE]
+                        @ bucket_matrix[start:].T)
+        rows, cols = np.nonzero(np.triu(similarities >= threshold, k=1))
+        for row, col in zip(bucket[start + rows].tolist(),
+                            bucket[start + cols].tolist()):
+          pairs.add((min(row, col), max(row, col)))
+  return pairs
+
+
+class HashIndex:
+  # Finds perceptual hashes within a Hamming distance of each other without
+  # comparing every pair. The hash is split into (distance + 1) bands; by the
+  # pigeonhole principle, hashes within the distance must match exactly in at
+  # least one band, so only hashes sharing a band bucket need comparing.
+
+  def __init__(self, distance: int, hash_bits: int = 64):
+    self.distance = distance
+    self.hash_bits = hash_bits
+    band_count = distance + 1
+    self.bands: list[tuple[int, int]] = []
+    start = 0
+    for band_index in range(band_count):
+      width = (hash_bits - start) // (band_count - band_index)
+      self.bands.append((start, (1 << width) - 1))
+      start += width
+    self.buckets: dict[tuple[int, int], list[str]] = {}
+    self.hashes: dict[str, int] = {}
+
+  def _band_keys(self, value: int) -> list[tuple[int, int]]:
+    return [(index, (value >> shift) & mask)
+            for index, (shift, mask) in enumerate(self.bands)]
+
+  def is_degenerate(self, value: int) -> bool:
+    bit_count = value.bit_count()
+    return min(bit_count, self.hash_bits - bit_count) < MIN_HASH_DETAIL_BITS
+
+  def add(self, key: str, value: int) -> None:
+    if self.is_degenerate(value):
+      return
+    self.hashes[key] = value
+    for band_key in self._band_keys(value):
+      self.buckets.setdefault(band_key, []).append(key)
+
+  def query(self, value: int) -> set[str]:
+    if self.is_degenerate(value):
+      return set()
+    matches = set()
+    for band_key in self._band_keys(value):
+      bucket = self.buckets.get(band_key, ())
+      if len(bucket) > MAX_HASH_BUCKET_SIZE:
+        continue
+      for key in bucket:
+        if (self.hashes[key] ^ value).bit_count() <= self.distance:
+          matches.add(key)
+    return matches
+
+  def pairs(self) -> set[tuple[str, str]]:
+    # Pairs often share several buckets, so candidates are collected first and
+    # each is only compared once
+    candidates = set()
+    for bucket in self.buckets.values():
+      if len(bucket) > MAX_HASH_BUCKET_SIZE:
+        continue
+      for index, key_a in enumerate(bucket):
+        for key_b in bucket[index + 1:]:
+          candidates.add((min(key_a, key_b), max(key_a, key_b)))
+    return set((key_a, key_b)
+               for key_a, key_b in candidates
+               if (self.hashes[key_a] ^
+                   self.hashes[key_b]).bit_count() <= self.distance)
@@ -0,0 +1,505 @@
+# Based on https://pypi.org/project/open-clip-torch/
+
+import contextlib
+from dataclasses import dataclass
+from dataclasses import field
+import math
+import multiprocessing.util
+import pathlib
+import threading
+import time
+from typing import Optional, TYPE_CHECKING
+
+import numpy as np
+from PIL import ExifTags
+from PIL import Image
+from PIL import ImageOps
+
+from src import geocode_manager
+from src import result_manager
+from src import saliency
+from src import thumbnail_manager
+from src.config import Config
+
+# The model, OCR & OpenCV libraries are slow to import (& use lots of memory),
+# so they're only imported when an image actually needs analysing
+if TYPE_CHECKING:
+  import torch
+
+PHRASE_GOOD = ' '.join((
+    'A photo thats interesting or fun, with a good subject.',
+    'A photo thats safe for work photo - people, animals, nature, etc.',
+    'A photo thats nice and clear & not blurry.',
+))
+PHRASE_BAD = ' '.join((
+    'A photo thats featureless or boring with no subject.',
+    'A photo thats not safe for work - bare skin, injuries, etc.',
+    'A photo of a document, screenshot, or lots of text.',
+    'A photo thats blurry and unclear.',
+))
+LABEL_WEIGHTS = {
+    PHRASE_GOOD: 5,
+    PHRASE_BAD: -5,
+}
+LABELS = list(LABEL_WEIGHTS.keys())
+LABEL_SET = set(LABELS)
+
+# Longest side of the image used to check whether it's worth running OCR
+TEXT_CHECK_SIZE = 512
+
+
+@dataclass
+class AnalysisImage:
+  # Reduced resolution copies of an image, decoded once & shared by all the
+  # analysis steps (each only needs a fraction of the original's pixels)
+  path: pathlib.Path
+  original_size: tuple[int, int]
+  exif: Image.Exif
+  # Decoded at the largest size the task needs (other than for OCR)
+  decoded: Image.Image
+  clip: Image.Image
+  orb: Image.Image
+  ocr_size: int
+  _ocr: Optional[Image.Image] = field(default=None, repr=False)
+
+  @property
+  def ocr(self) -> Image.Image:
+    # Only made when OCR actually runs; most images are skipped by the text
+    # gate, so they aren't decoded at the (bigger) OCR size at all
+    if self._ocr is None:
+      source = self.decoded
+      if (max(source.size) < self.ocr_size and
+          source.size != self.original_size):
+        source, _, _ = _decode(self.path, self.ocr_size, 0)
+      self._ocr = _fit_longest(source, self.ocr_size)
+    return self._ocr
+
+
+def _fit_longest(image: Image.Image, size: int) -> Image.Image:
+  longest = max(image.size)
+  if longest <= size:
+    return image
+  # Shrinking by a whole factor (box filter) is much quicker than resampling,
+  # so it does most of the work & resampling only does what's left
+  factor = longest // size
+  if factor > 1:
+    image = image.reduce(factor)
+    longest = max(image.size)
+    if longest <= size:
+      return image
+  scale = size / longest
+  new_size = (max(round(image.width * scale),
+                  1), max(round(image.height * scale), 1))
+  return image.resize(new_size, Image.Resampling.BILINEAR)
+
+
+def _fit_shortest(image: Image.Image, size: int) -> Image.Image:
+  scale = size / min(image.size)
+  if scale >= 1:
+    return image
+  new_size = (math.ceil(image.width * scale), math.ceil(image.height * scale))
+  return image.resize(new_size, Image.Resampling.BICUBIC)
+
+
+def _decode(
+    path: pathlib.Path,
+    longest: int,
+    shortest: int,
+) -> tuple[Image.Image, Image.Exif, tuple[int, int]]:
+  # Decodes at least longest (on the longest side) & shortest (on the shortest)
+  # & also returns the EXIF & stored size
+  with Image.open(path) as image:
+    exif = image.getexif()
+    # Let the JPEG decoder do the (much cheaper) DCT scaling down to it
+    width, height = image.size
+    scale = max(longest / max(width, height), shortest / min(width, height))
+    if scale < 1:
+      image.draft('RGB', (math.ceil(width * scale), math.ceil(height * scale)))
+    decoded = ImageOps.exif_transpose(image)
+  # Palette & other modes can't be reduced (& every consumer wants RGB or L)
+  if decoded.mode not in ('RGB', 'L'):
+    decoded = decoded.convert('RGB')
+  return decoded, exif, (width, height)
+
+
+def load_analysis_image(path: pathlib.Path, config: Config,
+                        task: 'AnalysisTask') -> AnalysisImage:
+  # Only what this task uses decides how big to decode (OCR decodes again if
+  # it's needed)
+  longest = config.orb_size
+  if task.needs_thumbnails:
+    longest = max(longest, thumbnail_manager.MAX_SIZE)
+  decoded, exif, (width, height) = _decode(path, longest, config.clip_size)
+
+  # Sizes here are after EXIF rotation, so they match what's used for cropping
+  if exif.get(ExifTags.Base.Orientation) in result_manager.ROTATED_ORIENTATIONS:
+    original_size = (height, width)
+  else:
+    original_size = (width, height)
+
+  # Each copy is made from the next biggest, rather than all from the decoded
+  # image
+  orb = _fit_longest(decoded, config.orb_size)
+  clip_source = orb if min(orb.size) >= config.clip_size else decoded
+  return AnalysisImage(
+      path=path,
+      original_size=original_size,
+      exif=exif,
+      decoded=decoded,
+      clip=_fit_shortest(clip_source, config.clip_size),
+      orb=orb.convert('L'),
+      ocr_size=config.ocr_size,
+  )
+
+
+def get_dhash(image: Image.Image) -> str:
+  # Difference hash: shrink to 9x8 & record whether each pixel is brighter than
+  # its right neighbour; resaves, resizes & small edits barely change it
+  pixels = np.asarray(
+      image.convert('L').resize((9, 8), Image.Resampling.LANCZOS),
+      dtype=np.int16,
+  )
+  bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+  return f'{int(np.packbits(bits).view(">u8")[0]):016x}'
+
+
+def get_text_likelihood(gray: Image.Image) -> float:
+  import cv2
+
+  # Text is made of lots of small, high contrast strokes, so images with very
+  # few strong edges (at low resolution) almost certainly don't contain any
+  small = np.asarray(_fit_longest(gray, TEXT_CHECK_SIZE))
+  edges = cv2.Canny(small, 100, 200)
+  return np.count_nonzero(edges) / edges.size
+
+
+@dataclass
+class AnalysisTask:
+  path: pathlib.Path
+  needs_centre: bool
+  needs_lat_lon: bool
+  needs_ocr: bool
+  needs_scores: bool
+  needs_phash: bool
+  needs_thumbnails: bool
+
+
+@dataclass
+class Analysis:
+  task: AnalysisTask
+  centre: Optional[tuple[float, float]] = None
+  saliency_timings: dict[str, float] = field(default_factory=dict)
+  saliency_distances: dict[str, float] = field(default_factory=dict)
+  lat_lon: Optional[result_manager.LatLon] = None
+  lat_lon_extracted: bool = False
+  ocr_text: Optional[str] = None
+  ocr_coverage: Optional[float] = None
+  ocr_skipped: bool = False
+  scores: Optional[dict[str, float]] = None
+  embedding: Optional[np.ndarray] = None
+  phash: Optional[str] = None
+  # Seconds spent in each stage & the error (if any) from each stage
+  timings: dict[str, float] = field(default_factory=dict)
+  errors: dict[str, str] = field(default_factory=dict)
+
+
+@contextlib.contextmanager
+def _timed(analysis: Analysis, stage: str):
+  start_time = time.perf_counter()
+  try:
+    yield
+  finally:
+    analysis.timings[stage] = time.perf_counter() - start_time
+
+
+class Analyzer:
+  # Does all the per-file work which doesn't need the result set, so it can be
+  # run in worker processes (each owning their own model, ORB & tesseract).
+  # Feature analysis may be run from several threads at once, so each thread
+  # gets its own tesseract API (& ORB detector, in the saliency engine).
+
+  def __init__(self, config: Config):
+    self.config = config
+
+    self._model = None
+    self._preprocess = None
+    self._text_features = None
+    self._backend = None
+    self._backend_checked = False
+
+    self.saliency_engine = saliency.SaliencyEngine(config)
+    self.thumbnails = thumbnail_manager.ThumbnailStore(config)
+    self._thread_local = threading.local()
+    self._tesser_apis = []
+    self._tesser_apis_lock = threading.Lock()
+
+  def end(self) -> None:
+    with self._tesser_apis_lock:
+      for tesser_api in self._tesser_apis:
+        tesser_api.End()
+      self._tesser_apis = []
+    self._thread_local = threading.local()
+
+  def analyze(self, tasks: list[AnalysisTask]) -> list[Analysis]:
+    analyses = []
+    to_score = []
+    for task in tasks:
+      analysis = Analysis(task=task)
+      analyses.append(analysis)
+      try:
+        image = self.load(analysis)
+      except Exception as ex:
+        analysis.errors['decode'] = f'Error loading - {ex}'
+        continue
+      self.analyze_features(analysis, image)
+      if task.needs_scores:
+        to_score.append((analysis, image))
+
+    if to_score:
+      self.score_analyses(to_score)
+
+    return analyses
+
+  def load(self, analysis: Analysis) -> AnalysisImage:
+    with _timed(analysis, 'decode'):
+      return load_analysis_image(analysis.task.path, self.config, analysis.task)
+
+  def analyze_features(self, analysis: Analysis, image: AnalysisImage) -> None:
+    task = analysis.task
+
+    # Find the centre (when necessary)
+    if task.needs_centre:
+      with _timed(analysis, 'centre'):
+        try:
+          (
+              analysis.centre,
+              analysis.saliency_timings,
+              analysis.saliency_distances,
+          ) = self.saliency_engine.find_centre(
+              np.asarray(image.orb),
+              image.original_size,
+          )
+        except Exception as ex:
+          analysis.errors['centre'] = f'Error finding centre - {ex}'
+
+    # Find the location (when necessary)
+    if task.needs_lat_lon:
+      with _timed(analysis, 'lat_lon'):
+        try:
+          analysis.lat_lon = geocode_manager.GeoCoder.extract_lat_lon(
+              image.exif)
+          analysis.lat_lon_extracted = True
+        except Exception as ex:
+          analysis.errors['lat_lon'] = f'Error extracting location - {ex}'
+
+    if task.needs_phash:
+      with _timed(analysis, 'phash'):
+        try:
+          analysis.phash = get_dhash(image.orb)
+        except Exception as ex:
+          analysis.errors['phash'] = f'Error hashing - {ex}'
+
+    if task.needs_ocr and self.config.tesser_path:
+      with _timed(analysis, 'ocr'):
+        try:
+          self._ocr(analysis, image)
+        except Exception as ex:
+          analysis.errors['ocr'] = f'Error running OCR - {ex}'
+
+    if task.needs_thumbnails:
+      with _timed(analysis, 'thumbnails'):
+        try:
+          # Reuse the decoded copy when it's big enough, rather than decoding
+          # again
+          if max(image.decoded.size) >= thumbnail_manager.MAX_SIZE or (
+              image.decoded.size == image.original_size):
+            self.thumbnails.build(task.path, image.decoded)
+          else:
+            self.thumbnails.build(task.path)
+        except Exception as ex:
+          analysis.errors['thumbnails'] = f'Error building thumbnails - {ex}'
+
+  def _get_tesser_api(self):
+    import tesserocr
+
+    tesser_api = getattr(self._thread_local, 'tesser_api', None)
+    if tesser_api is None:
+      tesser_api = tesserocr.PyTessBaseAPI(path=self.config.tesser_path)
+      self._thread_local.tesser_api = tesser_api
+      with self._tesser_apis_lock:
+        self._tesser_apis.append(tesser_api)
+    return tesser_api
+
+  def _ocr(self, analysis: Analysis, image: AnalysisImage) -> None:
+    import tesserocr
+
+    # Skip OCR for images which clearly have no text (most photos!)
+    if self.config.ocr_gate_threshold:
+      text_likelihood = get_text_likelihood(image.orb)
+      if text_likelihood < self.config.ocr_gate_threshold:
+        analysis.ocr_text = ''
+        analysis.ocr_coverage = 0
+        analysis.ocr_skipped = True
+        return
+
+    tesser_api = self._get_tesser_api()
+    # Coverage is a proportion of the image so it's the same at any resolution
+    tesser_api.SetImage(image.ocr)
+    analysis.ocr_text = tesser_api.GetUTF8Text()
+    if analysis.ocr_text:
+      # boxes = tesser_api.GetComponentImages(tesserocr.RIL.TEXTLINE, True)
+      boxes = tesser_api.GetComponentImages(tesserocr.RIL.BLOCK, True)
+      text_pixels = 0
+      for _, box, _, _ in boxes:
+        text_pixels += box['w'] * box['h']
+      image_pixels = image.ocr.size[0] * image.ocr.size[1]
+      analysis.ocr_coverage = text_pixels / image_pixels
+
+  def score_analyses(self, to_score: list[tuple[Analysis,
+                                                AnalysisImage]]) -> None:
+    if self._model is None:
+      self._init_model()
+
+    # Preprocess individually so one bad image doesn't fail the whole batch
+    processed_analyses = []
+    processed_images = []
+    for analysis, image in to_score:
+      try:
+        processed_images.append(self._preprocess(image.clip))
+        processed_analyses.append(analysis)
+      except Exception as ex:
+        analysis.errors['score'] = f'Error scoring - {ex}'
+
+    if not processed_images:
+      return
+
+    start_time = time.perf_counter()
+    try:
+      scores_list, embeddings = self._score(processed_images)
+    except Exception as ex:
+      if len(processed_images) == 1:
+        processed_analyses[0].errors['score'] = f'Error scoring - {ex}'
+        return
+      # Retry one at a time to find the image(s) which are causing problems
+      self.config.log(
+          f'  Error scoring batch of {len(processed_images)} - {ex}; retrying individually...'
+      )
+      for analysis, processed_image in zip(processed_analyses,
+                                           processed_images):
+        with _timed(analysis, 'score'):
+          try:
+            scores_list, embeddings = self._score([processed_image])
+            analysis.scores = scores_list[0]
+            analysis.embedding = embeddings[0]
+          except Exception as ex:
+            analysis.errors['score'] = f'Error scoring - {ex}'
+      return
+
+    # Each image gets an equal share of the batch's time
+    seconds = (time.perf_counter() - start_time) / len(processed_images)
+    for analysis, scores, embedding in zip(processed_analyses, scores_list,
+                                           embeddings):
+      analysis.scores = scores
+      analysis.embedding = embedding
+      analysis.timings['score'] = seconds
+
+  def _init_model(self) -> None:
+    import open_clip
+    import torch
+
+    from src import inference_backend
+
+    model, _, preprocess = open_clip.create_model_and_transforms(
+        'ViT-B-32', pretrained=self.config.clip_pretrained)
+    model.eval(
+    )  # model in train mode by default, impacts some models with BatchNorm or stochastic depth active
+    tokenizer = open_clip.get_tokenizer('ViT-B-32')
+
+    text = tokenizer(LABELS)
+    with torch.no_grad():
+      text_features = model.encode_text(text)
+      text_features /= text_features.norm(dim=-1, keepdim=True)
+
+    self._model = model
+    self._preprocess = preprocess
+    self._text_features = text_features
+    self._backend = inference_backend.create_backend(self.config, model.visual)
+    # The eager model is always right, so doesn't need checking
+    self._backend_checked = isinstance(self._backend,
+                                       inference_backend.TorchBackend)
+
+  def _check_backend(self, images: 'torch.Tensor') -> None:
+    from src import inference_backend
+
+    # Make sure the backend gives (almost) the same label probabilities as the
+    # eager model before trusting it; otherwise fall back to the eager model
+    eager_backend = inference_backend.TorchBackend(self._model.visual)
+    eager_probs = self._get_probs(eager_backend.encode_image(images))
+    backend_probs = self._get_probs(self._backend.encode_image(images))
+    difference = (eager_probs - backend_probs).abs().max().item()
+    if difference <= self.config.backend_tolerance:
+      self.config.log(
+          f'Using {self._backend.name} backend (max difference {difference:.04f})'
+      )
+      # The eager image tower isn't needed any more, so free its memory
+      self._model.visual = None
+    else:
+      self.config.log(
+          f'{self._backend.name} backend differs from eager model by {difference:.04f} (> {self.config.backend_tolerance}); using eager model'
+      )
+      self._backend = eager_backend
+    self._backend_checked = True
+
+  def _get_probs(self, image_features: 'torch.Tensor') -> 'torch.Tensor':
+    image_features = image_features.float()
+    image_features /= image_features.norm(dim=-1, keepdim=True)
+    return (100.0 * image_features @ self._text_features.T).softmax(dim=-1)
+
+  def _score(
+      self, processed_images: list['torch.Tensor']
+  ) -> tuple[list[dict[str, float]], np.ndarray]:
+    import torch
+
+    images = torch.stack(processed_images)
+    if not self._backend_checked:
+      self._check_backend(images)
+    image_features = self._backend.encode_image(images).float()
+    image_features /= image_features.norm(dim=-1, keepdim=True)
+    text_probs = (100.0 *
+                  image_features @ self._text_features.T).softmax(dim=-1)
+    scores_list = [dict(zip(LABELS, probs)) for probs in text_probs.tolist()]
+    return scores_list, image_features.numpy()
+
+  def encode_texts(self, labels: list[str]) -> np.ndarray:
+    import open_clip
+    import torch
+
+    if self._model is None:
+      self._init_model()
+    tokenizer = open_clip.get_tokenizer('ViT-B-32')
+    with torch.no_grad():
+      text_features = self._model.encode_text(tokenizer(labels))
+      text_features /= text_features.norm(dim=-1, keepdim=True)
+    return text_features.float().numpy()
+
+
+# Each worker process gets its own analyzer (created by the pool initializer)
+_WORKER_ANALYZER: Optional[Analyzer] = None
+
+
+def init_worker(config: Config) -> None:
+  import cv2
+  import torch
+
+  global _WORKER_ANALYZER
+  # Workers run in parallel so make sure they don't fight over cores
+  torch.set_num_threads(1)
+  cv2.setNumThreads(1)
+  _WORKER_ANALYZER = Analyzer(config)
+  # Workers exit through multiprocessing (which skips atexit), so the OCR APIs
+  # are ended by one of its finalizers
+  multiprocessing.util.Finalize(None, _WORKER_ANALYZER.end, exitpriority=10)
+
+
+def analyze_in_worker(tasks: list[AnalysisTask]) -> list[Analysis]:
+  return _WORKER_ANALYZER.analyze(tasks)
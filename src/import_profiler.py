@@ -0,0 +1,85 @@
+import builtins
+from dataclasses import dataclass
+import sys
+import threading
+import time
+from typing import Callable, Optional
+
+from src.metrics import get_rss
+
+_original_import = builtins.__import__
+
+
+@dataclass
+class ImportRecord:
+  name: str
+  seconds: float
+  rss_bytes: int
+  # Whether this was imported from within another (recorded) import
+  nested: bool
+
+
+_records: list[ImportRecord] = []
+# How deep in (recorded) imports each thread is, so imports on other threads
+# aren't counted as nested in this one's
+_local = threading.local()
+_start_time: Optional[float] = None
+_start_rss = 0
+
+
+def _profiled_import(name, globals=None, locals=None, fromlist=(), level=0):
+  if level:
+    # Relative imports are rare here, so don't bother resolving them
+    return _original_import(name, globals, locals, fromlist, level)
+
+  # `from package import module` imports module without calling __import__
+  # again, so check the fromlist for modules which aren't imported yet
+  new_names = [name] if name not in sys.modules else []
+  for from_name in fromlist or ():
+    full_name = f'{name}.{from_name}'
+    if full_name not in sys.modules and not hasattr(sys.modules.get(name),
+                                                    from_name):
+      new_names.append(full_name)
+  if not new_names:
+    return _original_import(name, globals, locals, fromlist, level)
+
+  start_time = time.perf_counter()
+  start_rss = get_rss()
+  depth = getattr(_local, 'depth', 0)
+  _local.depth = depth + 1
+  try:
+    return _original_import(name, globals, locals, fromlist, level)
+  finally:
+    _local.depth = depth
+    _records.append(
+        ImportRecord(
+            name=', '.join(new_names),
+            seconds=time.perf_counter() - start_time,
+            rss_bytes=get_rss() - start_rss,
+            nested=depth > 0,
+        ))
+
+
+def install() -> None:
+  global _start_time, _start_rss
+  _start_time = time.perf_counter()
+  _start_rss = get_rss()
+  builtins.__import__ = _profiled_import
+
+
+def report(log: Callable[[str], None], limit: int = 20) -> None:
+  if _start_time is None:
+    return
+  wall_time = time.perf_counter() - _start_time
+  top_level = [record for record in _records if not record.nested]
+  import_time = sum(record.seconds for record in top_level)
+  log('\n'.join((
+      f'Import profile ({len(_records)} imports):',
+      f'  Wall time: {wall_time:.03f}s (imports: {import_time:.03f}s)',
+      f'  RSS: {get_rss() / 2**20:.01f}MB (+{(get_rss() - _start_rss) / 2**20:.01f}MB)',
+      '  Slowest top level imports:',
+      *(f'    {record.seconds:7.03f}s {record.rss_bytes / 2**20:+7.01f}MB  {record.name}'
+        for record in sorted(
+            top_level, key=lambda record: record.seconds, reverse=True)[:limit]
+       ),
+  )))
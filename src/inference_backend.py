@@ -0,0 +1,155 @@
+import os
+import pathlib
+import tempfile
+
+import torch
+
+from src.config import Config
+from src.config import InferenceBackendType
+
+# Shape of a batch of preprocessed images for ViT-B-32
+INPUT_SHAPE = (3, 224, 224)
+
+
+class TorchBackend:
+  # Runs the image tower with the (eager) PyTorch model
+
+  name = 'torch'
+
+  def __init__(self, visual: torch.nn.Module):
+    self.visual = visual
+
+  def encode_image(self, images: torch.Tensor) -> torch.Tensor:
+    with torch.no_grad():
+      if torch.cuda.is_available():
+        # This is supposed to make things faster/more efficient but doesn't seem to do much;
+        # however, it does stop memory going crazy & getting the process killed after some time.
+        with torch.autocast('cuda'):
+          return self.visual(images)
+      return self.visual(images)
+
+
+class TorchScriptBackend:
+  # Runs a traced (& optionally int8 quantized) copy of the image tower
+
+  name = 'torchscript'
+
+  def __init__(self, path: pathlib.Path, visual: torch.nn.Module,
+               quantize: bool):
+    if not path.exists():
+      if quantize:
+        visual = torch.ao.quantization.quantize_dynamic(visual,
+                                                        {torch.nn.Linear},
+                                                        dtype=torch.qint8)
+      with torch.no_grad():
+        traced = torch.jit.trace(visual, torch.zeros((1, *INPUT_SHAPE)))
+      _save_atomic(path, lambda temp_path: torch.jit.save(traced, temp_path))
+    self.module = torch.jit.load(path)
+    self.module.eval()
+
+  def encode_image(self, images: torch.Tensor) -> torch.Tensor:
+    with torch.no_grad():
+      return self.module(images)
+
+
+class OnnxBackend:
+  # Runs an exported (& optionally int8 quantized) copy of the image tower with
+  # ONNX Runtime, which is usually quite a bit quicker on CPU
+
+  name = 'onnx'
+
+  def __init__(self, path: pathlib.Path, visual: torch.nn.Module,
+               quantize: bool):
+    try:
+      import onnxruntime
+    except ImportError as ex:
+      raise Exception(
+          'The onnx backend needs the onnx extras: uv sync --extra onnx'
+      ) from ex
+
+    if not path.exists():
+      if quantize:
+        float_path = path.with_name(path.name.replace('-int8', ''))
+        if not float_path.exists():
+          _export_onnx(float_path, visual)
+        from onnxruntime import quantization
+        _save_atomic(
+            path, lambda temp_path: quantization.quantize_dynamic(
+                float_path,
+                temp_path,
+                weight_type=quantization.QuantType.QInt8,
+            ))
+      else:
+        _export_onnx(path, visual)
+
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = (
+        onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL)
+    self.session = onnxruntime.InferenceSession(
+        str(path),
+        sess_options=options,
+        providers=['CPUExecutionProvider'],
+    )
+    self.input_name = self.session.get_inputs()[0].name
+
+  def encode_image(self, images: torch.Tensor) -> torch.Tensor:
+    (features,) = self.session.run(None, {self.input_name: images.numpy()})
+    return torch.from_numpy(features)
+
+
+def _save_atomic(path: pathlib.Path, save_func) -> None:
+  # Multiple workers may export at the same time; writing to a temporary file
+  # then renaming means nothing ever loads a half written model
+  path.parent.mkdir(parents=True, exist_ok=True)
+  with tempfile.NamedTemporaryFile(dir=path.parent,
+                                   suffix=path.suffix,
+                                   delete=False) as temp_file:
+    temp_path = temp_file.name
+  try:
+    save_func(temp_path)
+    os.replace(temp_path, path)
+  except Exception:
+    os.unlink(temp_path)
+    raise
+
+
+def _export_onnx(path: pathlib.Path, visual: torch.nn.Module) -> None:
+  _save_atomic(
+      path, lambda temp_path: torch.onnx.export(
+          visual,
+          (torch.zeros((1, *INPUT_SHAPE)),),
+          temp_path,
+          input_names=['images'],
+          output_names=['features'],
+          dynamic_axes={
+              'images': {
+                  0: 'batch'
+              },
+              'features': {
+                  0: 'batch'
+              },
+          },
+      ))
+
+
+def create_backend(config: Config, visual: torch.nn.Module):
+  if config.inference_backend == InferenceBackendType.TORCH:
+    return TorchBackend(visual)
+
+  suffix = '-int8' if config.quantize else ''
+  model_dir = config.cache_dir / 'models'
+  try:
+    if config.inference_backend == InferenceBackendType.TORCHSCRIPT:
+      return TorchScriptBackend(model_dir / f'vit-b-32{suffix}.pt', visual,
+                                config.quantize)
+    elif config.inference_backend == InferenceBackendType.ONNX:
+      return OnnxBackend(model_dir / f'vit-b-32{suffix}.onnx', visual,
+                         config.quantize)
+  except Exception as ex:
+    # Exporting (or loading the exported model) depends on the installed
+    # versions, so scoring carries on (more slowly) rather than failing
+    config.log(
+        f'Error creating {config.inference_backend.value} backend; using torch instead - {ex}'
+    )
+    return TorchBackend(visual)
+  raise Exception(f'Unknown inference backend: {config.inference_backend}')
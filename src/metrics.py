@@ -0,0 +1,152 @@
+import contextlib
+from dataclasses import dataclass
+from dataclasses import field
+import resource
+import sys
+import threading
+import time
+from typing import Callable, Iterator
+
+PREFIX = 'auto_image'
+
+# Upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+           10, 30)
+
+# (name, ((label, value), ...))
+CounterKey = tuple[str, tuple[tuple[str, str], ...]]
+
+
+@dataclass
+class Histogram:
+  # Count of observations <= each bucket (plus +Inf), like Prometheus
+  bucket_counts: list[int] = field(
+      default_factory=lambda: [0] * (len(BUCKETS) + 1))
+  total: float = 0
+  count: int = 0
+
+  def observe(self, seconds: float) -> None:
+    for index, bound in enumerate(BUCKETS):
+      if seconds <= bound:
+        self.bucket_counts[index] += 1
+    self.bucket_counts[-1] += 1
+    self.total += seconds
+    self.count += 1
+
+
+_lock = threading.Lock()
+_histograms: dict[str, Histogram] = {}
+_counters: dict[CounterKey, float] = {}
+# Functions returning values which are tracked elsewhere (e.g. cache stats)
+_collectors: list[Callable[[], dict[str, float]]] = []
+
+
+def observe(stage: str, seconds: float) -> None:
+  with _lock:
+    if stage not in _histograms:
+      _histograms[stage] = Histogram()
+    _histograms[stage].observe(seconds)
+
+
+@contextlib.contextmanager
+def timer(stage: str) -> Iterator[None]:
+  start_time = time.perf_counter()
+  try:
+    yield
+  finally:
+    observe(stage, time.perf_counter() - start_time)
+
+
+def increment(name: str, amount: float = 1, **labels: str) -> None:
+  key = (name, tuple(sorted(labels.items())))
+  with _lock:
+    _counters[key] = _counters.get(key, 0) + amount
+
+
+def register_collector(collector: Callable[[], dict[str, float]]) -> None:
+  _collectors.append(collector)
+
+
+def get_rss() -> int:
+  # Current (rather than peak) RSS is only easily available on Linux
+  try:
+    with open('/proc/self/statm') as f:
+      return int(f.read().split()[1]) * resource.getpagesize()
+  except OSError:
+    # ru_maxrss is KB on Linux but bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+  if not labels:
+    return ''
+  return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+def _get_counters() -> dict[CounterKey, float]:
+  with _lock:
+    counters = dict(_counters)
+  for collector in _collectors:
+    for name, value in collector().items():
+      counters[(name, ())] = value
+  return counters
+
+
+def render() -> str:
+  # Prometheus text exposition format
+  lines = []
+  with _lock:
+    histograms = {
+        stage: (list(histogram.bucket_counts), histogram.total, histogram.count)
+        for stage, histogram in _histograms.items()
+    }
+  if histograms:
+    name = f'{PREFIX}_stage_seconds'
+    lines.append(f'# HELP {name} Time spent in each processing stage')
+    lines.append(f'# TYPE {name} histogram')
+    for stage, (bucket_counts, total, count) in sorted(histograms.items()):
+      for bound, bucket_count in zip((*BUCKETS, '+Inf'), bucket_counts):
+        lines.append(
+            f'{name}_bucket{{stage="{stage}",le="{bound}"}} {bucket_count}')
+      lines.append(f'{name}_sum{{stage="{stage}"}} {total}')
+      lines.append(f'{name}_count{{stage="{stage}"}} {count}')
+
+  counters_by_name: dict[str, list[tuple[str, float]]] = {}
+  for (name, labels), value in _get_counters().items():
+    counters_by_name.setdefault(name, []).append(
+        (_format_labels(labels), value))
+  for name, values in sorted(counters_by_name.items()):
+    lines.append(f'# TYPE {PREFIX}_{name}_total counter')
+    for labels, value in sorted(values):
+      lines.append(f'{PREFIX}_{name}_total{labels} {value:g}')
+  return '\n'.join(lines) + '\n'
+
+
+def summary() -> str:
+  with _lock:
+    histograms = sorted(_histograms.items())
+  lines = ['Metrics:']
+  if histograms:
+    lines.append(
+        f'  {"Stage":<20} {"Count":>7} {"Total":>9} {"Mean":>10} {"Max bucket":>11}'
+    )
+  for stage, histogram in histograms:
+    mean = histogram.total / histogram.count
+    # The smallest bucket which holds every observation
+    max_bucket = next(
+        (f'<={bound}s'
+         for bound, bucket_count in zip(BUCKETS, histogram.bucket_counts)
+         if bucket_count == histogram.count),
+        f'>{BUCKETS[-1]}s',
+    )
+    lines.append(' '.join((
+        f'  {stage:<20}',
+        f'{histogram.count:>7}',
+        f'{histogram.total:>8.02f}s',
+        f'{1000 * mean:>8.02f}ms',
+        f'{max_bucket:>11}',
+    )))
+  for (name, labels), value in sorted(_get_counters().items()):
+    lines.append(f'  {name}{_format_labels(labels)}: {value:g}')
+  return '\n'.join(lines)
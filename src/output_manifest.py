@@ -0,0 +1,62 @@
+import json
+import os
+import tempfile
+from typing import Iterable, Optional
+
+from src import crop_cache
+from src.config import Config
+
+
+class OutputManifest:
+  # Remembers the signature of everything which went into rendering each output
+  # (the crop cache key: source file, centre, text, crop & font config) so
+  # outputs can be re-rendered when any of it changes, without re-rendering
+  # everything else
+
+  def __init__(self, config: Config):
+    self.config = config
+    self.path = self.config.output_dir / '_auto_image_outputs.json'
+    self.signatures: dict[str, str] = {}
+    # Outputs written before there was a manifest have unknown signatures
+    self.exists = self.path.exists()
+    if self.exists:
+      with self.path.open('r') as f:
+        self.signatures = json.load(f)
+    # Whether there are changes which haven't been saved yet
+    self._dirty = False
+
+  def save(self) -> None:
+    if not self._dirty:
+      return
+    self._dirty = False
+    try:
+      # Kept in the output directory (where it's ignored as it starts with
+      # _auto_image) so it can't get out of step with the outputs
+      with tempfile.NamedTemporaryFile(mode='w',
+                                       dir=self.path.parent,
+                                       prefix=self.path.name,
+                                       suffix=crop_cache.TEMP_SUFFIX,
+                                       delete=False) as temp_file:
+        json.dump(self.signatures, temp_file, ensure_ascii=False)
+      os.replace(temp_file.name, self.path)
+      self.exists = True
+    except Exception:
+      self._dirty = True
+      raise
+
+  def get(self, file_id: str) -> Optional[str]:
+    return self.signatures.get(file_id)
+
+  def set(self, file_id: str, signature: str) -> None:
+    if self.signatures.get(file_id) != signature:
+      self.signatures[file_id] = signature
+      self._dirty = True
+
+  def retain(self, file_ids: Iterable[str]) -> None:
+    # Forgets every output which isn't in file_ids
+    keep = set(file_ids)
+    removed = [file_id for file_id in self.signatures if file_id not in keep]
+    for file_id in removed:
+      del self.signatures[file_id]
+    if removed:
+      self._dirty = True
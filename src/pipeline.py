@@ -0,0 +1,202 @@
+from concurrent import futures
+import os
+import pathlib
+import queue
+import threading
+import time
+from typing import Iterator
+
+from src import image_analyzer
+from src import scan_manager
+from src.config import Config
+
+EXTENSIONS = ('jpg', 'png')
+HIDE_SKIP_EXTENSIONS = ('mp4', 'html', 'gif', 'json', 'npy', 'db', 'db-shm',
+                        'db-wal', 'migrated', 'log')
+# Where the cache used to be kept (in the input directory)
+LEGACY_CACHE_NAME = '_auto_image_cache'
+
+# Put on a queue to tell the next stage there's nothing more coming
+_END = None
+
+
+class FileWalker:
+  # Walks the input directory in a background thread so the rest of processing
+  # can start before the (potentially slow) directory listing has finished.
+  # Yields (path, signature) for every image found.
+
+  def __init__(self, config: Config):
+    self.config = config
+    self.found_count = 0
+    self.completed = False
+    self.path_queue: queue.Queue = queue.Queue(maxsize=1000)
+    self._cache_dir = config.cache_dir.absolute()
+    self._thread = threading.Thread(target=self._walk, daemon=True)
+    self._thread.start()
+
+  def _walk(self) -> None:
+    try:
+      for path, stat in self._scan(self.config.input_dir.absolute()):
+        if (self.config.max_images and
+            self.found_count >= self.config.max_images):
+          self.config.log('Hit limit; stopping...')
+          return
+        self.found_count += 1
+        self.path_queue.put((path, scan_manager.get_signature(stat)))
+      self.completed = True
+    except Exception as ex:
+      self.config.log(f'Error walking files - {ex}')
+    finally:
+      self.path_queue.put(_END)
+
+  def _scan(
+      self,
+      directory: str,
+  ) -> Iterator[tuple[pathlib.Path, os.stat_result]]:
+    # Uses scandir directly (rather than rglob + is_file) so each file only
+    # needs a single stat
+    with os.scandir(directory) as entries:
+      for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+          # Caches from before they were moved out of the input directory are
+          # skipped too
+          if (entry.path != str(self._cache_dir) and
+              entry.name != LEGACY_CACHE_NAME):
+            yield from self._scan(entry.path)
+          continue
+
+        if entry.name == '.DS_Store':
+          continue
+        extension = os.path.splitext(entry.name)[1].lower().lstrip('.')
+        if extension not in EXTENSIONS:
+          if extension not in HIDE_SKIP_EXTENSIONS:
+            self.config.log(f'  Skipping non-image: {entry.name}')
+          continue
+
+        if entry.is_file():
+          yield pathlib.Path(entry.path), entry.stat()
+
+  def __iter__(self) -> Iterator[tuple[pathlib.Path, scan_manager.Signature]]:
+    while (item := self.path_queue.get()) is not _END:
+      yield item
+
+
+class AnalysisPipeline:
+  # Runs analysis as a series of stages joined by bounded queues so disk, CPU
+  # & model all stay busy without holding too many decoded images in memory:
+  #   decode (thread pool, prefetching) -> features (centre, EXIF, OCR; several
+  #   threads as OCR releases the GIL) -> model
+  # Finished analyses are collected from `done_queue` by the caller.
+
+  def __init__(self, config: Config, analyzer: image_analyzer.Analyzer):
+    self.config = config
+    self.analyzer = analyzer
+
+    self.task_queue: queue.Queue = queue.Queue(maxsize=config.prefetch)
+    # Holds futures, so also limits how many images are being decoded at once
+    self.decode_queue: queue.Queue = queue.Queue(maxsize=config.prefetch)
+    self.model_queue: queue.Queue = queue.Queue(maxsize=2 *
+                                                config.score_batch_size)
+    # Only holds analysis results (not images), so doesn't need bounding
+    self.done_queue: queue.Queue = queue.Queue()
+
+    self._decode_executor = futures.ThreadPoolExecutor(
+        max_workers=config.decode_threads)
+    feature_thread_count = max(config.ocr_threads, 1)
+    # The last feature thread to finish tells the model stage to finish
+    self._feature_threads_running = feature_thread_count
+    self._feature_threads_lock = threading.Lock()
+    self._threads = [
+        threading.Thread(target=self._decode_stage, daemon=True),
+        *(threading.Thread(target=self._feature_stage, daemon=True)
+          for _ in range(feature_thread_count)),
+        threading.Thread(target=self._model_stage, daemon=True),
+    ]
+    for thread in self._threads:
+      thread.start()
+
+  def put(self, task: image_analyzer.AnalysisTask) -> None:
+    self.task_queue.put(task)
+
+  def finish(self) -> None:
+    self.task_queue.put(_END)
+    for thread in self._threads:
+      thread.join()
+    self._decode_executor.shutdown()
+
+  def get_done(self) -> list[image_analyzer.Analysis]:
+    analyses = []
+    while True:
+      try:
+        analyses.append(self.done_queue.get_nowait())
+      except queue.Empty:
+        return analyses
+
+  def queue_depths(self) -> dict[str, int]:
+    return {
+        'task': self.task_queue.qsize(),
+        'decode': self.decode_queue.qsize(),
+        'model': self.model_queue.qsize(),
+        'done': self.done_queue.qsize(),
+    }
+
+  def _decode_stage(self) -> None:
+    while (task := self.task_queue.get()) is not _END:
+      analysis = image_analyzer.Analysis(task=task)
+      future = self._decode_executor.submit(self.analyzer.load, analysis)
+      self.decode_queue.put((analysis, future))
+    self.decode_queue.put(_END)
+
+  def _feature_stage(self) -> None:
+    while (item := self.decode_queue.get()) is not _END:
+      analysis, future = item
+      task = analysis.task
+      try:
+        image = future.result()
+      except Exception as ex:
+        analysis.errors['decode'] = f'Error loading - {ex}'
+        self.done_queue.put(analysis)
+        continue
+
+      self.analyzer.analyze_features(analysis, image)
+      if task.needs_scores:
+        self.model_queue.put((analysis, image))
+      else:
+        self.done_queue.put(analysis)
+
+    # Pass the end marker on to the other feature threads
+    self.decode_queue.put(_END)
+    with self._feature_threads_lock:
+      self._feature_threads_running -= 1
+      if self._feature_threads_running == 0:
+        self.model_queue.put(_END)
+
+  def _model_stage(self) -> None:
+    finished = False
+    while not finished:
+      # Wait for the first item of a batch, then fill it until it's full or
+      # we've waited long enough
+      item = self.model_queue.get()
+      if item is _END:
+        break
+      batch: list[tuple[image_analyzer.Analysis,
+                        image_analyzer.AnalysisImage]] = [item]
+      batch_time = time.perf_counter() + self.config.score_batch_wait
+      while len(batch) < self.config.score_batch_size:
+        timeout = batch_time - time.perf_counter()
+        try:
+          item = self.model_queue.get(timeout=max(timeout, 0))
+        except queue.Empty:
+          break
+        if item is _END:
+          finished = True
+          break
+        batch.append(item)
+
+      try:
+        self.analyzer.score_analyses(batch)
+      except Exception as ex:
+        for analysis, _ in batch:
+          analysis.errors['score'] = f'Error scoring - {ex}'
+      for analysis, _ in batch:
+        self.done_queue.put(analysis)
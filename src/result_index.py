@@ -0,0 +1,191 @@
+from dataclasses import dataclass
+import datetime
+import threading
+from typing import Optional, TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+  from src.result_manager import Result
+
+# Result fields which are copied into the columns
+INDEXED_FIELDS = frozenset((
+    'group_index',
+    'include_override',
+    'is_chosen',
+    'lat_lon',
+    'ocr_coverage',
+    'ocr_text',
+    'path',
+    'taken',
+    'total',
+))
+
+# Stored in include_override
+OVERRIDE_CODES = {None: -1, False: 0, True: 1}
+# Stored in group_index for ungrouped results
+NO_GROUP = -1
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def to_seconds(value: datetime.datetime) -> float:
+  # How taken is stored (naive datetimes, so no timezone conversion)
+  return (value - EPOCH).total_seconds()
+
+
+@dataclass
+class Columns:
+  # One row per result; None is stored as NaN (or a code for int columns)
+  results: list['Result']
+  total: np.ndarray
+  # Seconds since 1970
+  taken: np.ndarray
+  lat: np.ndarray
+  lon: np.ndarray
+  ocr_coverage: np.ndarray
+  ocr_text_length: np.ndarray
+  is_chosen: np.ndarray
+  include_override: np.ndarray
+  group_index: np.ndarray
+  has_path: np.ndarray
+
+
+# (name, dtype, value for empty rows)
+COLUMNS = (
+    ('total', np.float64, 0),
+    ('taken', np.float64, np.nan),
+    ('lat', np.float64, np.nan),
+    ('lon', np.float64, np.nan),
+    ('ocr_coverage', np.float64, np.nan),
+    ('ocr_text_length', np.int64, 0),
+    ('is_chosen', np.bool_, False),
+    ('include_override', np.int8, OVERRIDE_CODES[None]),
+    ('group_index', np.int64, NO_GROUP),
+    ('has_path', np.bool_, False),
+)
+
+
+class ResultIndex:
+  # Columns of the fields results are filtered & sorted by, so queries over all
+  # results are numpy operations rather than Python loops. Results mark
+  # themselves stale when an indexed field changes; their rows are rewritten
+  # when the columns are next read (so bulk changes are written together).
+
+  def __init__(self):
+    self._results: list[Result] = []
+    self._row_by_file_id: dict[str, int] = {}
+    self._arrays = {
+        name: np.full(0, empty, dtype=dtype) for name, dtype, empty in COLUMNS
+    }
+    self._stale: dict[str, Result] = {}
+    self._lock = threading.Lock()
+    # Bumped whenever a result's phash is set or results are added, so anything
+    # built from the hashes (e.g. the duplicate index) knows to rebuild
+    self.phash_generation = 0
+
+  def mark_stale(self, result: 'Result') -> None:
+    with self._lock:
+      self._stale[result.file_id] = result
+
+  def mark_phash_changed(self) -> None:
+    with self._lock:
+      self.phash_generation += 1
+
+  def get_columns(self) -> Columns:
+    with self._lock:
+      self._refresh()
+      # Copied so later changes don't affect queries which are running
+      size = len(self._results)
+      return Columns(
+          results=list(self._results),
+          **{
+              name: array[:size].copy() for name, array in self._arrays.items()
+          },
+      )
+
+  def _refresh(self) -> None:
+    if not self._stale:
+      return
+    stale = list(self._stale.values())
+    self._stale = {}
+
+    rows = []
+    for result in stale:
+      row = self._row_by_file_id.get(result.file_id)
+      if row is None:
+        row = len(self._results)
+        self._row_by_file_id[result.file_id] = row
+        self._results.append(result)
+      rows.append(row)
+    self._reserve(len(self._results))
+
+    rows_array = np.array(rows, dtype=np.int64)
+    for name, values in self._get_values(stale).items():
+      self._arrays[name][rows_array] = values
+
+  def _reserve(self, size: int) -> None:
+    capacity = len(self._arrays['total'])
+    if size <= capacity:
+      return
+    # Grow by doubling so adding results one at a time is still quick
+    capacity = max(size, 2 * capacity, 1024)
+    for name, dtype, empty in COLUMNS:
+      array = np.full(capacity, empty, dtype=dtype)
+      old_array = self._arrays[name]
+      array[:len(old_array)] = old_array
+      self._arrays[name] = array
+
+  def _get_values(self, results: list['Result']) -> dict[str, list]:
+    return {
+        'total': [result.total for result in results],
+        'taken': [
+            to_seconds(result.taken) if result.taken else np.nan
+            for result in results
+        ],
+        'lat': [
+            result.lat_lon.lat if result.lat_lon else np.nan
+            for result in results
+        ],
+        'lon': [
+            result.lat_lon.lon if result.lat_lon else np.nan
+            for result in results
+        ],
+        'ocr_coverage': [
+            np.nan if result.ocr_coverage is None else result.ocr_coverage
+            for result in results
+        ],
+        'ocr_text_length': [len(result.ocr_text or '') for result in results],
+        'is_chosen': [result.is_chosen for result in results],
+        'include_override': [
+            OVERRIDE_CODES[result.include_override] for result in results
+        ],
+        'group_index': [
+            NO_GROUP if result.group_index is None else result.group_index
+            for result in results
+        ],
+        'has_path': [result.path is not None for result in results],
+    }
+
+
+def get_taken_order(columns: Columns) -> np.ndarray:
+  # Sorts like `result.taken or datetime.datetime.min`
+  return np.nan_to_num(columns.taken, nan=-np.inf)
+
+
+def argsort(keys: tuple[np.ndarray, ...], rows: np.ndarray,
+            reverse: bool) -> np.ndarray:
+  # Sorts rows by keys (most significant first), stably like sorted()
+  if reverse:
+    # sorted(reverse=True) keeps equal items in their original order
+    reversed_rows = rows[::-1]
+    order = np.lexsort([key[reversed_rows] for key in reversed(keys)])
+    return reversed_rows[order][::-1]
+  order = np.lexsort([key[rows] for key in reversed(keys)])
+  return rows[order]
+
+
+def get_date(seconds: float) -> Optional[datetime.date]:
+  if np.isnan(seconds):
+    return None
+  return (EPOCH + datetime.timedelta(seconds=float(seconds))).date()
@@ -1,19 +1,27 @@
 import dataclasses
 import datetime
+import hashlib
 from io import BytesIO
 import json
+import math
 import os
 import pathlib
 import re
-import tempfile
-from typing import Optional
+import sqlite3
+import threading
+import time
+from typing import Callable, Optional
 
 import cachetools
+from PIL import ExifTags
 from PIL import Image
 from PIL import ImageDraw
 from PIL import ImageOps
 
+from src import metrics
+from src import result_index
 from src.config import Config
+from src.config import ResultEncoding
 
 # 2024-10-21 10.52.09-1.jpg
 # skin-2018-07-18 12.59.08-2.jpg
@@ -23,8 +31,25 @@ DATETIME_RE = r'.*(\d{4}-?\d{2}-?\d{2}[ _]\d{2}.?\d{2}.?\d{2})'
 DATE_RE = r'.*(\d{4}-?\d{2}-?\d{2})'
 DATETIME_FORMAT = '%Y%m%d %H%M%S'
 
-IMAGE_CACHE = cachetools.LRUCache(maxsize=128)
-CROP_CACHE = cachetools.LRUCache(maxsize=128)
+# EXIF orientations which swap width & height
+ROTATED_ORIENTATIONS = (5, 6, 7, 8)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+  file_id TEXT PRIMARY KEY,
+  taken TEXT,
+  total REAL NOT NULL,
+  is_chosen INTEGER NOT NULL,
+  group_index INTEGER,
+  -- Everything (as returned by Result.to_dict); a JSON object, or a list of
+  -- values in COMPACT_KEYS order
+  data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_taken ON results (taken);
+CREATE INDEX IF NOT EXISTS results_total ON results (total);
+CREATE INDEX IF NOT EXISTS results_is_chosen ON results (is_chosen);
+CREATE INDEX IF NOT EXISTS results_group_index ON results (group_index);
+"""
 
 
 @dataclasses.dataclass
@@ -33,11 +58,34 @@ class LatLon:
   lon: float
 
 
-def _result_cache_key(result, *args, **kwargs):
-  return f'{result.file_id}-{result.centre}-{result.description}-{result.location}'
-
-
-@dataclasses.dataclass
+# Order of values in rows saved with the compact encoding (only ever append to
+# this, so older rows can still be read)
+COMPACT_KEYS = (
+    'centre',
+    'description',
+    'file_id',
+    'group_index',
+    'include_override',
+    'is_chosen',
+    'lat_lon',
+    'lat_lon_extracted',
+    'location',
+    'needs_update',
+    'ocr_coverage',
+    'ocr_skipped',
+    'ocr_text',
+    'path',
+    'phash',
+    'scores',
+    'taken',
+    'total',
+)
+
+# Default for fields which haven't been set yet
+_UNSET = object()
+
+
+@dataclasses.dataclass(slots=True)
 class Result:
   file_id: str
   scores: dict[str, dict[str, float]]
@@ -53,13 +101,45 @@ class Result:
   location: Optional[str] = None
   needs_update: bool = False
   ocr_coverage: Optional[float] = None
+  ocr_skipped: bool = False
   ocr_text: Optional[str] = None
   path: Optional[pathlib.Path] = None
+  phash: Optional[str] = None
   total: float = 0
 
-  # Recalculated each time
+  # Parsed from the filename when the result is created
   taken: Optional[datetime.datetime] = None
 
+  # Set whenever any field changes, so saving can skip unchanged results
+  _dirty: bool = dataclasses.field(default=True,
+                                   init=False,
+                                   repr=False,
+                                   compare=False)
+  # Told when any indexed field changes
+  _index: Optional[result_index.ResultIndex] = dataclasses.field(default=None,
+                                                                 init=False,
+                                                                 repr=False,
+                                                                 compare=False)
+
+  def __setattr__(self, name: str, value) -> None:
+    # This runs for every field as results are created, so avoid super()
+    if name[0] == '_':
+      object.__setattr__(self, name, value)
+      return
+    # Assigning an equal value isn't a change (fields aren't set yet while
+    # __init__ is running)
+    unchanged = getattr(self, name, _UNSET) == value
+    object.__setattr__(self, name, value)
+    if unchanged:
+      return
+    object.__setattr__(self, '_dirty', True)
+    # _index isn't set yet while __init__ is running
+    if name in result_index.INDEXED_FIELDS and (index := getattr(
+        self, '_index', None)):
+      index.mark_stale(self)
+    elif name == 'phash' and (index := getattr(self, '_index', None)):
+      index.mark_phash_changed()
+
   def get_time_taken_text(self, config: Config) -> Optional[str]:
     if self.taken:
       return self.taken.strftime(config.taken_format)
@@ -68,8 +148,19 @@ class Result:
 
   @property
   def image(self) -> Image.Image:
+    return self.get_image().image
+
+  def get_original_size(self) -> tuple[int, int]:
+    # Only reads the header, so this is quick
+    if not self.path:
+      raise Exception(f'Can\'t get size when path is not set! {self.file_id}')
+    with Image.open(self.path) as image:
+      return get_original_size(image)
+
+  def get_image(self,
+                cover_size: Optional[tuple[int, int]] = None) -> 'DecodedImage':
     if self.path:
-      return load_image(self.path)
+      return load_image(self.path, cover_size)
     else:
       raise Exception(f'Can\'t get image when path is not set! {self.file_id}')
 
@@ -91,37 +182,60 @@ class Result:
     return datetime.datetime.strptime(dt, DATETIME_FORMAT)
 
   @classmethod
-  def from_dict(cls, data: dict, config: Config) -> 'Result':
+  def from_dict(
+      cls,
+      data: dict,
+      config: Config,
+      path_exists: Callable[[str], bool] = os.path.exists,
+  ) -> 'Result':
     if lat_lon_data := data.pop('lat_lon'):
       lat_lon = LatLon(**lat_lon_data)
     else:
       lat_lon = None
 
-    if path_data := data.pop('path'):
-      path_potential = pathlib.Path(path_data)
-      if path_potential.exists():
-        path = path_potential
+    path = None
+    if (path_data := data.pop('path')) and path_exists(path_data):
+      path = pathlib.Path(path_data)
+
+    # Older data doesn't include when the photo was taken
+    if 'taken' in data:
+      taken = (datetime.datetime.fromisoformat(data['taken'])
+               if data['taken'] else None)
     else:
-      path = None
-
-    return Result(
-        centre=data['centre'],
-        file_id=data['file_id'],
-        description=data.get('description'),
-        group_index=data['group_index'],
-        include_override=data['include_override'],
-        is_chosen=data['is_chosen'],
-        lat_lon=lat_lon,
-        lat_lon_extracted=data['lat_lon_extracted'],
-        location=data['location'],
-        needs_update=data.get('needs_update', False),
-        ocr_coverage=data['ocr_coverage'],
-        ocr_text=data['ocr_text'],
-        path=path,
-        scores=data['scores'],
-        taken=Result.parse_filename(data['file_id'], config),
-        total=data['total'],
-    )
+      taken = Result.parse_filename(data['file_id'], config)
+
+    return Result._from_fields(
+        dict(
+            centre=data['centre'],
+            file_id=data['file_id'],
+            description=data.get('description'),
+            group_index=data['group_index'],
+            include_override=data['include_override'],
+            is_chosen=data['is_chosen'],
+            lat_lon=lat_lon,
+            lat_lon_extracted=data['lat_lon_extracted'],
+            location=data['location'],
+            needs_update=data.get('needs_update', False),
+            ocr_coverage=data['ocr_coverage'],
+            ocr_skipped=data.get('ocr_skipped', False),
+            ocr_text=data['ocr_text'],
+            path=path,
+            phash=data.get('phash'),
+            scores=data['scores'],
+            taken=taken,
+            total=data['total'],
+        ))
+
+  @classmethod
+  def _from_fields(cls, fields: dict) -> 'Result':
+    # Like Result(**fields), but without __setattr__ running for every field
+    # (which is most of the time taken to load a large result set)
+    result = cls.__new__(cls)
+    for name, value in fields.items():
+      object.__setattr__(result, name, value)
+    object.__setattr__(result, '_dirty', True)
+    object.__setattr__(result, '_index', None)
+    return result
 
   def to_dict(self) -> dict:
     return {
@@ -136,12 +250,29 @@ class Result:
         'location': self.location,
         'needs_update': self.needs_update,
         'ocr_coverage': self.ocr_coverage,
+        'ocr_skipped': self.ocr_skipped,
         'ocr_text': self.ocr_text,
         'path': str(self.path) if self.path else None,
+        'phash': self.phash,
         'scores': self.scores,
+        'taken': self.taken.isoformat() if self.taken else None,
         'total': self.total,
     }
 
+  def reset_analysis(self) -> None:
+    # The file has changed, so everything derived from it needs recalculating
+    self.centre = None
+    self.lat_lon = None
+    self.lat_lon_extracted = False
+    self.location = None
+    self.ocr_coverage = None
+    self.ocr_skipped = False
+    self.ocr_text = None
+    self.phash = None
+    self.scores = {}
+    self.total = 0
+    self.needs_update = True
+
   def update_include_override(self, include_override: Optional[bool]) -> None:
     self.include_override = include_override
     if self.include_override == True:
@@ -151,13 +282,16 @@ class Result:
     # Otherwise, this will need to be updated next time processing is done
 
   def get_cropped(self, config: Config) -> Image.Image:
-    image_width, image_height = self.image.size
+    crop_size = (config.crop_width, config.crop_height)
+    # Only decode as many pixels as the crop needs
+    decoded = self.get_image(crop_size)
+    # The centre is in full resolution pixels
+    image_width, image_height = decoded.original_size
     if self.centre:
       centre = (self.centre[0] / image_width, self.centre[1] / image_height)
     else:
       centre = (0.5, 0.5)
-    cropped = ImageOps.fit(self.image, (config.crop_width, config.crop_height),
-                           centering=centre)
+    cropped = ImageOps.fit(decoded.image, crop_size, centering=centre)
 
     draw = ImageDraw.Draw(cropped)
 
@@ -185,7 +319,6 @@ class Result:
 
     return cropped
 
-  @cachetools.cached(CROP_CACHE, key=_result_cache_key)
   def get_cropped_bytes(self, config: Config) -> bytes:
     cropped = self.get_cropped(config)
     img_io = BytesIO()
@@ -198,53 +331,331 @@ class Result:
     self.needs_update = True
 
 
-@cachetools.cached(IMAGE_CACHE)
-def load_image(path: pathlib.Path) -> Image.Image:
-  image = Image.open(path)
+@dataclasses.dataclass
+class DecodedImage:
+  image: Image.Image
+  # Size of the full resolution image (after EXIF rotation)
+  original_size: tuple[int, int]
+
+  @property
+  def size_bytes(self) -> int:
+    # Pillow stores 8-bit single band images in a byte per pixel & (nearly)
+    # everything else, including RGB, in 4
+    bytes_per_pixel = 1 if self.image.mode in ('1', 'L', 'P') else 4
+    return self.image.width * self.image.height * bytes_per_pixel
+
+
+def get_source_key(path: pathlib.Path) -> str:
+  # Changes whenever the file does (without reading it)
+  stat = path.stat()
+  return hashlib.sha256(
+      json.dumps((
+          str(path.absolute()),
+          stat.st_size,
+          stat.st_mtime_ns,
+      )).encode()).hexdigest()
+
+
+def get_original_size(image: Image.Image) -> tuple[int, int]:
+  # Size after EXIF rotation (which is what centres & crops are relative to)
+  if image.getexif().get(ExifTags.Base.Orientation) in ROTATED_ORIENTATIONS:
+    return (image.height, image.width)
+  return image.size
+
+
+def open_image(path: pathlib.Path,
+               cover_size: Optional[tuple[int, int]] = None) -> DecodedImage:
+  # cover_size is the smallest (width, height) the image will be cropped to;
+  # the JPEG decoder can cheaply scale the image down to just cover it
+  with Image.open(path) as image:
+    width, height = image.size
+    original_size = get_original_size(image)
+    if cover_size:
+      scale = max(cover_size[0] / original_size[0],
+                  cover_size[1] / original_size[1])
+      if scale < 1:
+        image.draft(image.mode,
+                    (math.ceil(width * scale), math.ceil(height * scale)))
+    # Decode before the file is closed (rather than leaving it open for as long
+    # as the image is cached)
+    image.load()
   ImageOps.exif_transpose(image, in_place=True)
-  return image
+  return DecodedImage(image=image, original_size=original_size)
+
+
+class ImageCache:
+  # Decoded images, limited by their total size rather than a count (a handful
+  # of 48MP photos is several GB). Reduced size variants are cached alongside
+  # the full size image.
+
+  def __init__(self, max_bytes: int):
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._lock = threading.Lock()
+    self._cache = self._create_cache(max_bytes)
+
+  @staticmethod
+  def _create_cache(max_bytes: int) -> cachetools.LRUCache:
+    return cachetools.LRUCache(
+        maxsize=max_bytes,
+        getsizeof=lambda decoded: decoded.size_bytes,
+    )
+
+  @property
+  def max_bytes(self) -> int:
+    return int(self._cache.maxsize)
+
+  @property
+  def current_bytes(self) -> int:
+    return int(self._cache.currsize)
+
+  def set_max_bytes(self, max_bytes: int) -> None:
+    with self._lock:
+      if max_bytes != self._cache.maxsize:
+        self._cache = self._create_cache(max_bytes)
+
+  def clear(self) -> None:
+    with self._lock:
+      self._cache.clear()
+
+  def get(self, key: tuple, load: Callable[[], DecodedImage]) -> DecodedImage:
+    with self._lock:
+      decoded = self._cache.get(key)
+      if decoded is not None:
+        self.hits += 1
+        return decoded
+      self.misses += 1
+
+    # Decoded without the lock so other images can be loaded at the same time
+    decoded = load()
+    with self._lock:
+      # Anything bigger than the whole budget isn't cached at all
+      if decoded.size_bytes <= self._cache.maxsize:
+        expected_count = len(self._cache) + (key not in self._cache)
+        self._cache[key] = decoded
+        self.evictions += expected_count - len(self._cache)
+    return decoded
+
+
+IMAGE_CACHE = ImageCache(Config.image_cache_bytes)
+
+
+def load_image(path: pathlib.Path,
+               cover_size: Optional[tuple[int, int]] = None) -> DecodedImage:
+  return IMAGE_CACHE.get((path, cover_size),
+                         lambda: open_image(path, cover_size))
+
+
+def _get_cache_metrics() -> dict[str, float]:
+  return {
+      'image_cache_hits': IMAGE_CACHE.hits,
+      'image_cache_misses': IMAGE_CACHE.misses,
+      'image_cache_evictions': IMAGE_CACHE.evictions,
+  }
+
+
+metrics.register_collector(_get_cache_metrics)
+
+
+class PathChecker:
+  # Checks files exist by listing each directory once, rather than checking
+  # every file separately (which is slow for large or network directories)
+
+  def __init__(self):
+    self._names_by_directory: dict[str, set[str]] = {}
+
+  def exists(self, path: str) -> bool:
+    directory, name = os.path.split(path)
+    names = self._names_by_directory.get(directory)
+    if names is None:
+      try:
+        names = set(os.listdir(directory))
+      except OSError:
+        names = set()
+      self._names_by_directory[directory] = names
+    return name in names
 
 
 class ResultSet:
+  # Results are stored in SQLite (one row per result, with the columns which
+  # are filtered/sorted on pulled out & indexed) so saving only has to write
+  # the results which have changed.
 
   def __init__(self, config: Config):
     self.config = config
-    self.path = self.config.input_dir / '_auto_image.json'
+    self.path = self.config.input_dir / '_auto_image.db'
+    self.json_path = self.config.input_dir / '_auto_image.json'
     self.results: dict[str, Result] = {}
-    if self.path.exists():
-      with self.path.open('r') as f:
-        data = json.load(f)
-
-      # Convert old structure
-      if isinstance(data, dict):
-        data_list = []
-        for file_id, item in data.items():
-          if '/' in file_id:
-            # If this is a path (rather than just a filename), update to use only the filename
-            file_id = file_id.split('/')[-1]
-          centre = item.pop('_centre')
-          data_list.append({
-              'centre': centre,
-              'file_id': file_id,
-              'scores': item,
-          })
-        data = data_list
-
-      for item in data:
-        result = Result.from_dict(item, config)
-        self.results[result.file_id] = result
+    self.index = result_index.ResultIndex()
+    self._lock = threading.Lock()
+    IMAGE_CACHE.set_max_bytes(config.image_cache_bytes)
+
+    migrate = not self.path.exists() and self.json_path.exists()
+    if migrate:
+      self._migrate_json()
+    # The server saves from several threads; the lock stops them overlapping
+    self._connection = self._connect(self.path)
+    if not migrate:
+      self._load()
+
+  @staticmethod
+  def _connect(path: pathlib.Path) -> sqlite3.Connection:
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript(SCHEMA)
+    return connection
+
+  def _load(self) -> None:
+    start_time = time.perf_counter()
+    start_rss = metrics.get_rss()
+    path_checker = PathChecker()
+    for file_id, data in self._connection.execute(
+        'SELECT file_id, data FROM results'):
+      # Rows keep the encoding they were saved with until they next change
+      data = json.loads(data)
+      if isinstance(data, list):
+        data = dict(zip(COMPACT_KEYS, data))
+      result = Result.from_dict(data, self.config, path_checker.exists)
+      # Nothing has changed since it was saved
+      result._dirty = False
+      self.add(result)
+
+    seconds = time.perf_counter() - start_time
+    metrics.observe('result_set_load', seconds)
+    self.config.log(
+        f'Loaded {len(self.results)} results in {seconds:.02f}s (RSS +{(metrics.get_rss() - start_rss) / 2**20:.01f}MB)'
+    )
+
+  def _migrate_json(self) -> None:
+    self.config.log(f'Migrating {self.json_path} to {self.path}...')
+    with self.json_path.open('r') as f:
+      data = json.load(f)
+
+    # Convert old structure
+    if isinstance(data, dict):
+      data_list = []
+      for file_id, item in data.items():
+        if '/' in file_id:
+          # If this is a path (rather than just a filename), update to use only the filename
+          file_id = file_id.split('/')[-1]
+        centre = item.pop('_centre')
+        data_list.append({
+            'centre': centre,
+            'file_id': file_id,
+            'description': None,
+            'group_index': None,
+            'include_override': None,
+            'is_chosen': False,
+            'lat_lon': None,
+            'lat_lon_extracted': False,
+            'location': None,
+            'ocr_coverage': None,
+            'ocr_text': None,
+            'path': None,
+            'scores': item,
+            'total': 0,
+        })
+      data = data_list
+
+    path_checker = PathChecker()
+    for item in data:
+      result = Result.from_dict(item, self.config, path_checker.exists)
+      self.add(result)
+
+    # Written to a temporary database (in a single transaction) which is only
+    # moved into place once everything's in it, so if anything goes wrong the
+    # migration is tried again next time
+    temp_path = self.path.with_name(f'{self.path.name}.migrating')
+    temp_path.unlink(missing_ok=True)
+    connection = self._connect(temp_path)
+    try:
+      self._save_rows(
+          connection,
+          [self._get_row(result) for result in self.results.values()])
+      connection.close()
+      os.replace(temp_path, self.path)
+    except Exception:
+      connection.close()
+      temp_path.unlink(missing_ok=True)
+      raise
+    for result in self.results.values():
+      result._dirty = False
+
+    # Keep the old file (but out of the way) in case anything went wrong
+    self.json_path.rename(
+        self.json_path.with_name(f'{self.json_path.name}.migrated'))
+    self.config.log(f'Migrated {len(self.results)} results')
 
   def save(self) -> None:
-    data = [result.to_dict() for result in self.results.values()]
-    with tempfile.NamedTemporaryFile(mode='w', delete=False) as temp_file:
-      json.dump(data, temp_file, indent=2, ensure_ascii=False)
-    os.replace(temp_file.name, self.path)
+    with self._lock:
+      # Copied as processing may add results while this is saving
+      dirty_results = [
+          result for result in list(self.results.values()) if result._dirty
+      ]
+      if not dirty_results:
+        return
+
+      rows = []
+      for result in dirty_results:
+        # Cleared first so any changes made while saving are saved next time
+        result._dirty = False
+        rows.append(self._get_row(result))
+      try:
+        self._save_rows(self._connection, rows)
+      except Exception:
+        for result in dirty_results:
+          result._dirty = True
+        raise
+
+  def _get_row(self, result: Result) -> tuple:
+    return (
+        result.file_id,
+        result.taken.isoformat() if result.taken else None,
+        result.total,
+        result.is_chosen,
+        result.group_index,
+        self._encode(result),
+    )
+
+  def _encode(self, result: Result) -> str:
+    data = result.to_dict()
+    if self.config.result_encoding == ResultEncoding.COMPACT:
+      return json.dumps([data[key] for key in COMPACT_KEYS],
+                        ensure_ascii=False,
+                        separators=(',', ':'))
+    return json.dumps(data, ensure_ascii=False)
+
+  @staticmethod
+  def _save_rows(connection: sqlite3.Connection, rows: list[tuple]) -> None:
+    with connection:
+      connection.executemany(
+          """
+          INSERT INTO results (file_id, taken, total, is_chosen, group_index, data)
+          VALUES (?, ?, ?, ?, ?, ?)
+          ON CONFLICT (file_id) DO UPDATE SET
+            taken=excluded.taken,
+            total=excluded.total,
+            is_chosen=excluded.is_chosen,
+            group_index=excluded.group_index,
+            data=excluded.data
+          """,
+          rows,
+      )
+
+  def add(self, result: Result) -> None:
+    self.results[result.file_id] = result
+    result._index = self.index
+    self.index.mark_stale(result)
+    self.index.mark_phash_changed()
 
   def get_result(self, file_id: str) -> Result:
     if file_id not in self.results:
-      self.results[file_id] = Result(
-          file_id=file_id,
-          scores={},
-          taken=Result.parse_filename(file_id, self.config),
-      )
+      self.add(
+          Result(
+              file_id=file_id,
+              scores={},
+              taken=Result.parse_filename(file_id, self.config),
+          ))
     return self.results[file_id]
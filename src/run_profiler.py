@@ -0,0 +1,198 @@
+import datetime
+import heapq
+import os
+import pathlib
+import sys
+import threading
+import time
+from types import FrameType
+from typing import Optional
+
+from PIL import Image
+
+from src import metrics
+from src.config import Config
+
+# Seconds between samples; low enough to see what's hot, high enough that
+# sampling doesn't noticeably slow processing down
+SAMPLE_INTERVAL = 0.01
+
+REPORT_DIR_NAME = '_auto_image_profiles'
+
+# (file basename, function name) of functions threads block in while they have
+# nothing to do; stacks ending in these are counted as idle, not as hot
+IDLE_FUNCTIONS = {
+    ('threading.py', 'wait'),
+    ('threading.py', 'join'),
+    ('threading.py', '_wait_for_tstate_lock'),
+    # Thread pool workers waiting for work
+    ('thread.py', '_worker'),
+    ('selectors.py', 'select'),
+    ('connection.py', 'wait'),
+}
+
+# (filename, first line, function name)
+FunctionKey = tuple[str, int, str]
+
+
+class SamplingProfiler:
+  # Periodically records the stack of every thread (unlike cProfile, which
+  # only sees the thread it was started on & slows everything down)
+
+  def __init__(self, interval: float = SAMPLE_INTERVAL):
+    self.interval = interval
+    self.sample_count = 0
+    self.idle_count = 0
+    self.self_counts: dict[FunctionKey, int] = {}
+    self.total_counts: dict[FunctionKey, int] = {}
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._run, daemon=True)
+
+  def start(self) -> None:
+    self._thread.start()
+
+  def stop(self) -> None:
+    self._stop.set()
+    self._thread.join()
+
+  def _run(self) -> None:
+    own_thread_id = threading.get_ident()
+    while not self._stop.wait(self.interval):
+      for thread_id, frame in sys._current_frames().items():
+        if thread_id != own_thread_id:
+          self._sample(frame)
+
+  def _sample(self, frame: FrameType) -> None:
+    code = frame.f_code
+    if (os.path.basename(code.co_filename), code.co_name) in IDLE_FUNCTIONS:
+      self.idle_count += 1
+      return
+    self.sample_count += 1
+    seen = set()
+    is_leaf = True
+    while frame is not None:
+      code = frame.f_code
+      key = (code.co_filename, code.co_firstlineno, code.co_name)
+      if is_leaf:
+        self.self_counts[key] = self.self_counts.get(key, 0) + 1
+        is_leaf = False
+      # Recursive functions only count once per sample
+      if key not in seen:
+        seen.add(key)
+        self.total_counts[key] = self.total_counts.get(key, 0) + 1
+      frame = frame.f_back
+
+
+class SlowFiles:
+  # Keeps the slowest few files for each stage
+
+  def __init__(self, count: int):
+    self.count = count
+    self.by_stage: dict[str, list[tuple[float, str]]] = {}
+    self._lock = threading.Lock()
+
+  def record(self, stage: str, seconds: float, path: pathlib.Path) -> None:
+    with self._lock:
+      heap = self.by_stage.setdefault(stage, [])
+      if len(heap) < self.count:
+        heapq.heappush(heap, (seconds, str(path)))
+      elif seconds > heap[0][0]:
+        heapq.heapreplace(heap, (seconds, str(path)))
+
+
+# The profile currently running (if any)
+_active: Optional['Profile'] = None
+
+
+def record_file(stage: str, seconds: float, path: pathlib.Path) -> None:
+  if _active:
+    _active.slow_files.record(stage, seconds, path)
+
+
+def _describe_file(path: str) -> str:
+  # Only looked up for the reported files, so it doesn't slow processing down
+  try:
+    size = f'{pathlib.Path(path).stat().st_size / 2**20:.01f}MB'
+  except OSError:
+    size = '?MB'
+  try:
+    with Image.open(path) as image:
+      dimensions = f'{image.width}x{image.height}'
+  except Exception:
+    dimensions = '?x?'
+  return f'{dimensions:>11} {size:>8}'
+
+
+def _format_function(key: FunctionKey) -> str:
+  filename, line, name = key
+  return f'{name} ({filename}:{line})'
+
+
+class Profile:
+  # Samples all threads & tracks the slowest files while running, then writes
+  # a report into the output directory
+
+  def __init__(self, config: Config, name: str, function_count: int = 30):
+    self.config = config
+    self.name = name
+    self.function_count = function_count
+    self.slow_files = SlowFiles(config.profile_file_count)
+    self.sampler = SamplingProfiler()
+    self.start_time = datetime.datetime.now()
+    self.wall_time = 0.0
+
+  def __enter__(self) -> 'Profile':
+    global _active
+    if _active:
+      raise Exception(f'Already profiling {_active.name}')
+    _active = self
+    self._perf_start = time.perf_counter()
+    self.sampler.start()
+    return self
+
+  def __exit__(self, *args) -> None:
+    global _active
+    self.sampler.stop()
+    self.wall_time = time.perf_counter() - self._perf_start
+    _active = None
+    path = self.write_report()
+    self.config.log(f'Profile written to {path}')
+
+  def write_report(self) -> pathlib.Path:
+    report_dir = self.config.output_dir / REPORT_DIR_NAME
+    report_dir.mkdir(parents=True, exist_ok=True)
+    path = report_dir / f'{self.start_time:%Y%m%d-%H%M%S}-{self.name}.txt'
+    with path.open('w') as f:
+      f.write('\n'.join(self.get_report_lines()) + '\n')
+    return path
+
+  def get_report_lines(self) -> list[str]:
+    sampler = self.sampler
+    lines = [
+        f'Profile: {self.name} ({self.start_time:%Y-%m-%d %H:%M:%S})',
+        f'Wall time: {self.wall_time:.02f}s',
+        f'Samples: {sampler.sample_count} busy thread stacks, {sampler.idle_count} idle (every {1000 * sampler.interval:.0f}ms)',
+    ]
+    if self.config.workers > 1:
+      lines.append(
+          'Worker processes aren\'t sampled; use --workers 1 to profile analysis'
+      )
+
+    for title, counts in (
+        ('Hottest functions (self)', sampler.self_counts),
+        ('Hottest functions (including callees)', sampler.total_counts),
+    ):
+      lines.extend(('', f'{title}:'))
+      top = sorted(counts.items(), key=lambda item: item[1], reverse=True)
+      for key, count in top[:self.function_count]:
+        percent = 100 * count / max(sampler.sample_count, 1)
+        lines.append(f'  {count:>7} {percent:5.01f}%  {_format_function(key)}')
+
+    lines.extend(('', 'Slowest files by stage:'))
+    for stage, heap in sorted(self.slow_files.by_stage.items()):
+      lines.append(f'  {stage}:')
+      for seconds, path in sorted(heap, reverse=True):
+        lines.append(f'    {seconds:8.03f}s {_describe_file(path)}  {path}')
+
+    lines.extend(('', metrics.summary()))
+    return lines
@@ -0,0 +1,199 @@
+from dataclasses import dataclass
+from dataclasses import field
+import math
+import threading
+import time
+from typing import Callable, Optional
+
+import numpy as np
+
+from src.config import Config
+from src.config import SaliencyMode
+
+# Width the spectral residual is calculated at; the algorithm is designed to
+# work on tiny images (it finds what stands out, not fine detail)
+SPECTRAL_SIZE = 64
+
+# Number of cells (along the longest side) keypoints are binned into when
+# looking for the densest area
+DENSITY_GRID = 16
+
+# (x, y) in whatever coordinates the strategy was given
+Point = tuple[float, float]
+
+
+class OrbStrategy:
+  # The mean position of all ORB keypoints
+
+  mode = SaliencyMode.ORB
+
+  def __init__(self):
+    self._thread_local = threading.local()
+
+  def get_key_points(self, gray: np.ndarray) -> np.ndarray:
+    import cv2
+
+    orb = getattr(self._thread_local, 'orb', None)
+    if orb is None:
+      orb = cv2.ORB_create()
+      self._thread_local.orb = orb
+    key_points = orb.detect(gray)
+    if not key_points:
+      return np.zeros((0, 2), dtype=np.float32)
+    return cv2.KeyPoint_convert(key_points)
+
+  def find_centre(self, gray: np.ndarray) -> Optional[Point]:
+    points = self.get_key_points(gray)
+    if not len(points):
+      return None
+    c_x, c_y = points.mean(axis=0)
+    return (float(c_x), float(c_y))
+
+
+class DensityStrategy(OrbStrategy):
+  # The centre of the densest cluster of ORB keypoints; unlike the mean, this
+  # isn't dragged into empty space between several textured areas
+
+  mode = SaliencyMode.DENSITY
+
+  def find_centre(self, gray: np.ndarray) -> Optional[Point]:
+    import cv2
+
+    points = self.get_key_points(gray)
+    if not len(points):
+      return None
+
+    height, width = gray.shape
+    cell_size = max(width, height) / DENSITY_GRID
+    grid_width = math.ceil(width / cell_size)
+    grid_height = math.ceil(height / cell_size)
+    counts, _, _ = np.histogram2d(
+        points[:, 1],
+        points[:, 0],
+        bins=(grid_height, grid_width),
+        range=((0, grid_height * cell_size), (0, grid_width * cell_size)),
+    )
+    # Smooth so a few neighbouring busy cells beat a single (noisy) one
+    density = cv2.GaussianBlur(counts.astype(np.float32), (3, 3), 0)
+    peak_y, peak_x = np.unravel_index(np.argmax(density), density.shape)
+
+    # Refine to the mean of the keypoints around the peak
+    peak = np.array(((peak_x + 0.5) * cell_size, (peak_y + 0.5) * cell_size))
+    nearby = points[np.abs(points - peak).max(axis=1) <= 1.5 * cell_size]
+    c_x, c_y = nearby.mean(axis=0) if len(nearby) else peak
+    return (float(c_x), float(c_y))
+
+
+class SpectralStrategy:
+  # Spectral residual saliency (Hou & Zhang, 2007): the parts of the log
+  # spectrum which differ from its local average are what make an image stand
+  # out. This is what OpenCV's StaticSaliencySpectralResidual does, but that
+  # needs opencv-contrib so it's done in NumPy instead.
+
+  mode = SaliencyMode.SPECTRAL
+
+  def find_centre(self, gray: np.ndarray) -> Optional[Point]:
+    import cv2
+
+    height, width = gray.shape
+    small_height = max(round(height * SPECTRAL_SIZE / width), 1)
+    small = cv2.resize(gray, (SPECTRAL_SIZE, small_height),
+                       interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    spectrum = np.fft.fft2(small)
+    log_amplitude = np.log(np.abs(spectrum) + 1e-9)
+    phase = np.angle(spectrum)
+    residual = log_amplitude - cv2.blur(log_amplitude, (3, 3))
+    saliency = np.abs(np.fft.ifft2(np.exp(residual + 1j * phase)))**2
+    saliency = cv2.GaussianBlur(saliency.astype(np.float32), (0, 0), 2.5)
+
+    # Centre of mass of the clearly salient area
+    saliency = np.maximum(saliency - saliency.mean(), 0)
+    total = saliency.sum()
+    if not total:
+      return None
+    ys, xs = np.indices(saliency.shape)
+    scale_x = width / SPECTRAL_SIZE
+    scale_y = height / small_height
+    return (
+        float((xs * saliency).sum() / total + 0.5) * scale_x,
+        float((ys * saliency).sum() / total + 0.5) * scale_y,
+    )
+
+
+STRATEGIES = {
+    strategy.mode: strategy
+    for strategy in (OrbStrategy, DensityStrategy, SpectralStrategy)
+}
+
+
+@dataclass
+class SaliencyStats:
+  # Totals of how long each strategy took & (when comparing strategies) how far
+  # its centres were from the selected strategy's, as a fraction of the diagonal
+  count: dict[str, int] = field(default_factory=dict)
+  seconds: dict[str, float] = field(default_factory=dict)
+  distance: dict[str, float] = field(default_factory=dict)
+
+  def add(self, timings: dict[str, float], distances: dict[str, float]) -> None:
+    for name, seconds in timings.items():
+      self.count[name] = self.count.get(name, 0) + 1
+      self.seconds[name] = self.seconds.get(name, 0) + seconds
+    for name, distance in distances.items():
+      self.distance[name] = self.distance.get(name, 0) + distance
+
+  def report(self, log: Callable[[str], None]) -> None:
+    if not self.count:
+      return
+    lines = ['Saliency timings:']
+    for name in sorted(self.count, key=lambda name: self.seconds[name]):
+      count = self.count[name]
+      line = f'  {name:>8}: {1000 * self.seconds[name] / count:7.02f}ms per image'
+      if name in self.distance:
+        line += f', {100 * self.distance[name] / count:5.01f}% from selected'
+      lines.append(line)
+    log('\n'.join(lines))
+
+
+class SaliencyEngine:
+  # Finds the point crops should be centred on, using the configured strategy
+  # (or every strategy, when comparing them)
+
+  def __init__(self, config: Config):
+    self.config = config
+    self.strategy = STRATEGIES[config.saliency]()
+    self.other_strategies = []
+    if config.saliency_report:
+      self.other_strategies = [
+          strategy()
+          for mode, strategy in STRATEGIES.items()
+          if mode != config.saliency
+      ]
+
+  def find_centre(
+      self, gray: np.ndarray, original_size: tuple[int, int]
+  ) -> tuple[Optional[Point], dict[str, float], dict[str, float]]:
+    # Returns the centre in original image coordinates, how long each strategy
+    # took & how far other strategies' centres were from it
+    scale_x = original_size[0] / gray.shape[1]
+    scale_y = original_size[1] / gray.shape[0]
+
+    timings = {}
+    centres = {}
+    for strategy in (self.strategy, *self.other_strategies):
+      start_time = time.perf_counter()
+      centre = strategy.find_centre(gray)
+      timings[strategy.mode.value] = time.perf_counter() - start_time
+      if centre:
+        centres[strategy.mode.value] = (int(centre[0] * scale_x),
+                                        int(centre[1] * scale_y))
+
+    centre = centres.get(self.strategy.mode.value)
+    distances = {}
+    if centre:
+      diagonal = math.hypot(*original_size)
+      for strategy in self.other_strategies:
+        if other_centre := centres.get(strategy.mode.value):
+          distances[strategy.mode.value] = math.dist(centre,
+                                                     other_centre) / diagonal
+    return centre, timings, distances
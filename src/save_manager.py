@@ -0,0 +1,81 @@
+import atexit
+import threading
+import time
+from typing import Callable, Optional, Sequence
+
+from src.config import Config
+
+
+class BackgroundSaver:
+  # Saves in a background thread once changes stop arriving (or they've been
+  # waiting for the maximum latency), so a burst of edits is a single write.
+  # Anything still waiting is saved when the process exits.
+
+  def __init__(self, config: Config, save_funcs: Sequence[Callable[[], None]]):
+    self.config = config
+    self.save_funcs = save_funcs
+
+    self._condition = threading.Condition()
+    self._first_request: Optional[float] = None
+    self._last_request: Optional[float] = None
+    self._stopping = False
+    # Stops the background thread & flush() saving at the same time
+    self._save_lock = threading.Lock()
+
+    self._thread = threading.Thread(target=self._run, daemon=True)
+    self._thread.start()
+    atexit.register(self.stop)
+
+  def request(self) -> None:
+    with self._condition:
+      now = time.monotonic()
+      if self._first_request is None:
+        self._first_request = now
+      self._last_request = now
+      self._condition.notify()
+
+  def flush(self) -> None:
+    with self._condition:
+      self._first_request = None
+      self._last_request = None
+    self._save()
+
+  def stop(self) -> None:
+    with self._condition:
+      if self._stopping:
+        return
+      self._stopping = True
+      self._condition.notify()
+    self._thread.join()
+    self._save()
+
+  def _run(self) -> None:
+    while True:
+      with self._condition:
+        while self._first_request is None and not self._stopping:
+          self._condition.wait()
+        if self._stopping:
+          # stop() does the final save
+          return
+
+        # Wait for changes to stop arriving (but not for too long)
+        while not self._stopping:
+          deadline = min(
+              self._last_request + self.config.save_delay,
+              self._first_request + self.config.save_max_latency,
+          )
+          remaining = deadline - time.monotonic()
+          if remaining <= 0:
+            break
+          self._condition.wait(remaining)
+        self._first_request = None
+        self._last_request = None
+      self._save()
+
+  def _save(self) -> None:
+    with self._save_lock:
+      for save_func in self.save_funcs:
+        try:
+          save_func()
+        except Exception as ex:
+          self.config.log(f'Error saving: {ex}')
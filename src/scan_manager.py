@@ -0,0 +1,97 @@
+from dataclasses import dataclass
+import json
+import os
+import pathlib
+import tempfile
+
+from src.config import Config
+
+NEW = 'new'
+MODIFIED = 'modified'
+UNCHANGED = 'unchanged'
+
+# (size, mtime_ns, inode)
+Signature = tuple[int, int, int]
+
+
+def get_signature(stat: os.stat_result) -> Signature:
+  return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+@dataclass
+class ScanCounts:
+  new: int = 0
+  modified: int = 0
+  unchanged: int = 0
+  removed: int = 0
+
+  def __str__(self):
+    return ', '.join((
+        f'Skipped: {self.unchanged}',
+        f'Rescanned: {self.modified}',
+        f'New: {self.new}',
+        f'Removed: {self.removed}',
+    ))
+
+
+class ScanManifest:
+  # Remembers the signature of every file seen so re-runs can tell which files
+  # are new or have been modified without opening them
+
+  def __init__(self, config: Config):
+    self.config = config
+    self.path = self.config.input_dir / '_auto_image_scan.json'
+    self.signatures: dict[str, Signature] = {}
+    if self.path.exists():
+      with self.path.open('r') as f:
+        data = json.load(f)
+      self.signatures = {path: tuple(signature) for path, signature in data}
+    self.counts = ScanCounts()
+    self._seen: set[str] = set()
+    # Whether there are changes which haven't been saved yet
+    self._dirty = False
+
+  def save(self) -> None:
+    if not self._dirty:
+      return
+    self._dirty = False
+    try:
+      data = list(self.signatures.items())
+      # Written next to the manifest, as renaming across devices fails
+      with tempfile.NamedTemporaryFile(mode='w',
+                                       dir=self.path.parent,
+                                       prefix=self.path.name,
+                                       suffix='.json',
+                                       delete=False) as temp_file:
+        json.dump(data, temp_file, ensure_ascii=False)
+      os.replace(temp_file.name, self.path)
+    except Exception:
+      self._dirty = True
+      raise
+
+  def update(self, path: pathlib.Path, signature: Signature) -> str:
+    key = str(path)
+    self._seen.add(key)
+    previous = self.signatures.get(key)
+    if previous != signature:
+      self.signatures[key] = signature
+      self._dirty = True
+    if previous is None:
+      self.counts.new += 1
+      return NEW
+    elif previous != signature:
+      self.counts.modified += 1
+      return MODIFIED
+    else:
+      self.counts.unchanged += 1
+      return UNCHANGED
+
+  def remove_unseen(self) -> None:
+    # Only call this after a complete scan, otherwise files which weren't
+    # reached would be forgotten
+    unseen = set(self.signatures.keys()) - self._seen
+    for key in unseen:
+      del self.signatures[key]
+    self.counts.removed += len(unseen)
+    if unseen:
+      self._dirty = True
@@ -1,43 +1,37 @@
-# Based on https://pypi.org/project/open-clip-torch/
-
+from concurrent import futures
+import dataclasses
 from dataclasses import dataclass
 from dataclasses import field
 import datetime
+import functools
+import multiprocessing
+import os
 import pathlib
-import statistics
+import shutil
 import time
 from typing import Optional
 
-import cv2
-import open_clip
-from PIL import Image
-import tesserocr
-import torch
+import numpy as np
 
+from src import crop_cache
+from src import embedding_manager
 from src import geocode_manager
+from src import group_manager
+from src import image_analyzer
+from src import metrics
+from src import output_manifest
+from src import pipeline
+from src import result_index
 from src import result_manager
+from src import run_profiler
+from src import saliency
+from src import scan_manager
+from src import thumbnail_manager
 from src.config import Config
+from src.config import GroupMode
 
-EXTENSIONS = ('jpg', 'png')
-HIDE_SKIP_EXTENSIONS = ('mp4', 'html', 'gif', 'json')
-
-PHRASE_GOOD = ' '.join((
-    'A photo thats interesting or fun, with a good subject.',
-    'A photo thats safe for work photo - people, animals, nature, etc.',
-    'A photo thats nice and clear & not blurry.',
-))
-PHRASE_BAD = ' '.join((
-    'A photo thats featureless or boring with no subject.',
-    'A photo thats not safe for work - bare skin, injuries, etc.',
-    'A photo of a document, screenshot, or lots of text.',
-    'A photo thats blurry and unclear.',
-))
-LABEL_WEIGHTS = {
-    PHRASE_GOOD: 5,
-    PHRASE_BAD: -5,
-}
-LABELS = list(LABEL_WEIGHTS.keys())
-LABEL_SET = set(LABELS)
+# Files in the output directory starting with this aren't output images
+OUTPUT_INTERNAL_PREFIX = '_auto_image'
 
 INCLUDE_OVERRIDE_ORDER = {
     # Included images should be first (so they should be included before hitting the limit)
@@ -58,7 +52,9 @@ class ProcessStats:
   last_index: int = 0
   last_time: float = field(default_factory=time.perf_counter)
 
-  def output(self, index: int) -> None:
+  def output(self,
+             index: int,
+             queue_depths: Optional[dict[str, int]] = None) -> None:
     new_time = time.perf_counter()
 
     diff_processed = index - self.last_index
@@ -72,21 +68,58 @@ class ProcessStats:
     self.config.log(
         f'Done {index} / {self.file_count} files (scored {index} in {wall_time:.01f}s, {processed_per_minute:.01f} per minute)'
     )
+    if queue_depths:
+      depths = ', '.join(
+          f'{name}={depth}' for name, depth in queue_depths.items())
+      self.config.log(f'  Queue depths: {depths}')
 
     self.last_index = index
     self.last_time = new_time
 
 
+@dataclass
+class OutputStats:
+  config: Config
+  file_count: int
+  succeeded: int = 0
+  failed: int = 0
+  # Succeeded since the result set was last saved
+  unsaved: int = 0
+  start_time: float = field(default_factory=time.perf_counter)
+  next_time: float = 0
+
+  def succeed(self) -> None:
+    self.succeeded += 1
+    self.unsaved += 1
+
+  def fail(self, file_id: str, ex: Exception) -> None:
+    self.failed += 1
+    self.config.log(f'  Error writing {file_id} - {ex}')
+
+  def output(self) -> None:
+    wall_time = time.perf_counter() - self.start_time
+    per_second = self.succeeded / wall_time if wall_time else 0
+    self.config.log(
+        f'  Written {self.succeeded} / {self.file_count} files ({self.failed} failed) in {wall_time:.01f}s, {per_second:.01f} per second'
+    )
+    self.next_time = time.perf_counter() + 5
+
+
 @dataclass
 class CompareFilesResult:
   file_ids_to_add: list[str]
   file_ids_to_update: list[str]
   paths_to_remove: list[pathlib.Path]
+  # Current render signature of every chosen file (None if it can't be
+  # rendered, e.g. the source is missing)
+  signatures: dict[str, Optional[str]] = field(default_factory=dict)
+  # How many updates are because the render inputs changed
+  stale_count: int = 0
 
   def __str__(self):
     return ', '.join((
         f'Add: {len(self.file_ids_to_add)}',
-        f'Update: {len(self.file_ids_to_update)}',
+        f'Update: {len(self.file_ids_to_update)} ({self.stale_count} stale)',
         f'Remove: {len(self.paths_to_remove)}',
     ))
 
@@ -103,11 +136,16 @@ class Scorer:
     self.result_set = result_set
     self.geocoder = geocoder
 
-    self._model = None
-    self._preprocess = None
-    self._text_features = None
-
-    self._orb = None
+    self.analyzer = image_analyzer.Analyzer(config)
+    self.scan_manifest = scan_manager.ScanManifest(config)
+    self.embedding_store = embedding_manager.EmbeddingStore(config)
+    self.crop_cache = crop_cache.CropCache(config)
+    self.output_manifest = output_manifest.OutputManifest(config)
+    self.thumbnails = thumbnail_manager.ThumbnailStore(config)
+    self._hash_index: Optional[group_manager.HashIndex] = None
+    # The phash generation _hash_index was built at
+    self._hash_index_generation = -1
+    self.saliency_stats = saliency.SaliencyStats()
 
   def process(self) -> None:
     self.process_files()
@@ -117,54 +155,100 @@ class Scorer:
 
   def process_files(self) -> None:
     self.config.log('Processing files...')
-    all_files = list(self.config.input_dir.rglob('*'))
+    walker = pipeline.FileWalker(self.config)
     next_time = 0
-    stats = ProcessStats(config=self.config, file_count=len(all_files))
-
-    if self.config.tesser_path:
-      tesser_api = tesserocr.PyTessBaseAPI(path=self.config.tesser_path)
+    stats = ProcessStats(config=self.config, file_count=0)
+
+    if self.config.workers > 1:
+      # Workers get a copy of the config which doesn't log through the server
+      worker_config = dataclasses.replace(self.config, log=print)
+      executor = futures.ProcessPoolExecutor(
+          max_workers=self.config.workers,
+          mp_context=multiprocessing.get_context('spawn'),
+          initializer=image_analyzer.init_worker,
+          initargs=(worker_config,),
+      )
+      analysis_pipeline = None
+      self.config.log(f'Started {self.config.workers} workers...')
     else:
-      tesser_api = None
-
-    for index, path in enumerate(all_files):
-      if self.config.max_images and index >= self.config.max_images:
-        self.config.log('Hit limit; stopping...')
-        break
-
-      if not path.is_file():
-        # Skip directories
-        continue
-
-      if path.name == '.DS_Store':
-        continue
-      extension = path.suffix.lower().lstrip('.')
-      if extension not in EXTENSIONS:
-        if extension not in HIDE_SKIP_EXTENSIONS:
-          self.config.log(f'  Skipping non-image: {path.name}')
-        continue
-
+      executor = None
+      analysis_pipeline = pipeline.AnalysisPipeline(self.config, self.analyzer)
+    in_flight: set[futures.Future] = set()
+
+    pending_tasks: list[image_analyzer.AnalysisTask] = []
+    pending_time = 0
+    index = 0
+    for index, (path, signature) in enumerate(walker):
       if time.perf_counter() >= next_time:
-        stats.output(index)
-        self.result_set.save()
-        self.geocoder.save()
+        stats.file_count = walker.found_count
+        queue_depths = {'walk': walker.path_queue.qsize()}
+        if analysis_pipeline:
+          queue_depths.update(analysis_pipeline.queue_depths())
+        else:
+          queue_depths['workers'] = len(in_flight)
+        stats.output(index, queue_depths)
+        self._save()
         next_time = time.perf_counter() + 5
 
-      self._update_score(path, tesser_api)
+      task = self._get_task(path, signature)
+      if analysis_pipeline:
+        if task:
+          analysis_pipeline.put(task)
+        self._merge_analyses(analysis_pipeline.get_done())
+        continue
 
-    if tesser_api:
-      tesser_api.End()
+      if task:
+        if not pending_tasks:
+          pending_time = time.perf_counter() + self.config.score_batch_wait
+        pending_tasks.append(task)
+
+      if pending_tasks and (len(pending_tasks) >= self.config.score_batch_size
+                            or time.perf_counter() >= pending_time):
+        self._run_tasks(pending_tasks, executor, in_flight)
+        pending_tasks = []
+      # Merge whatever's finished (without waiting) so results are saved &
+      # reported as they arrive
+      self._merge_done(in_flight, futures.FIRST_COMPLETED, timeout=0)
+
+    if analysis_pipeline:
+      analysis_pipeline.finish()
+      self._merge_analyses(analysis_pipeline.get_done())
+      self.analyzer.end()
+    else:
+      if pending_tasks:
+        self._run_tasks(pending_tasks, executor, in_flight)
+      self._merge_done(in_flight, futures.ALL_COMPLETED)
+      executor.shutdown()
 
+    stats.file_count = walker.found_count
     stats.output(index)
-    self.result_set.save()
-    self.geocoder.save()
+    if walker.completed:
+      self.scan_manifest.remove_unseen()
+    self.config.log(f'Scan result: {self.scan_manifest.counts}')
+    self.saliency_stats.report(self.config.log)
+    self._save()
+    with metrics.timer('save'):
+      self.embedding_store.compact()
 
     self.config.log('Processing done!')
 
-  def _update_score(self, path: pathlib.Path,
-                    tesser_api: Optional[tesserocr.PyTessBaseAPI]) -> None:
+  def _save(self) -> None:
+    with metrics.timer('save'):
+      self.result_set.save()
+      self.geocoder.save()
+      self.scan_manifest.save()
+      self.embedding_store.save()
+
+  def _get_task(
+      self,
+      path: pathlib.Path,
+      signature: scan_manager.Signature,
+  ) -> Optional[image_analyzer.AnalysisTask]:
+    # Works out what analysis this path still needs; if it doesn't need any,
+    # the result is updated straight away (unless the file hasn't changed).
+
     # Get the result for this path
     result = self.result_set.get_result(path.name)
-    path = path.absolute()
 
     if result.path and result.path != path:
       self.config.log('\n'.join((
@@ -172,94 +256,141 @@ class Scorer:
           f'    -> {result.path}',
           f'    -> {path}',
       )))
-      return
-
-    result.path = path
-
-    # Find the centre (when necessary)
-    if not result.centre:
-      result.centre = self._get_centre(result.path)
-
-    # Find the location (when necessary)
-    if not result.lat_lon_extracted:
-      result.lat_lon = self.geocoder.extract_lat_lon(result.image)
-      result.lat_lon_extracted = True
-    if result.lat_lon:
-      result.location = self.geocoder.get_name(result.lat_lon)
+      return None
 
-    if tesser_api and result.ocr_text is None:
-      tesser_api.SetImage(result.image)
-      result.ocr_text = tesser_api.GetUTF8Text()
-      if result.ocr_text:
-        # boxes = tesser_api.GetComponentImages(tesserocr.RIL.TEXTLINE, True)
-        boxes = tesser_api.GetComponentImages(tesserocr.RIL.BLOCK, True)
-        text_pixels = 0
-        for _, box, _, _ in boxes:
-          text_pixels += box['w'] * box['h']
-        image_pixels = result.image.size[0] * result.image.size[1]
-        result.ocr_coverage = text_pixels / image_pixels
-
-    # Process the scores (when necessary)
-    if LABEL_SET.difference(result.scores):
-      if self._model is None:
-        self._init_model()
+    scan_status = self.scan_manifest.update(path, signature)
+    metrics.increment('files', status=scan_status)
+    if scan_status == scan_manager.MODIFIED:
+      self.config.log(f'  File has changed: {path.name}')
+      result.reset_analysis()
+
+    if result.path != path:
+      result.path = path
+    # Unchanged files had their thumbnails built when they were first seen
+    needs_thumbnails = (scan_status != scan_manager.UNCHANGED and
+                        not self.thumbnails.has(path))
+
+    task = image_analyzer.AnalysisTask(
+        path=path,
+        needs_centre=not result.centre,
+        needs_lat_lon=not result.lat_lon_extracted,
+        needs_ocr=bool(self.config.tesser_path) and result.ocr_text is None,
+        needs_phash=result.phash is None,
+        needs_thumbnails=needs_thumbnails,
+        needs_scores=any((
+            image_analyzer.LABEL_SET.difference(result.scores),
+            not self.embedding_store.has(result.file_id),
+        )),
+    )
+    if any((
+        task.needs_centre,
+        task.needs_lat_lon,
+        task.needs_ocr,
+        task.needs_scores,
+        task.needs_phash,
+    )):
+      metrics.increment('bytes_read', signature[0])
+      return task
+
+    if needs_thumbnails:
+      self.thumbnails.queue(path)
+    if scan_status != scan_manager.UNCHANGED:
+      self._update_result(result)
+    return None
+
+  def _run_tasks(
+      self,
+      tasks: list[image_analyzer.AnalysisTask],
+      executor: futures.Executor,
+      in_flight: set[futures.Future],
+  ) -> None:
+    # Keep enough work queued that workers never go idle, but not so much that
+    # memory grows without bound
+    if len(in_flight) >= 2 * self.config.workers:
+      self._merge_done(in_flight, futures.FIRST_COMPLETED)
+    in_flight.add(executor.submit(image_analyzer.analyze_in_worker, tasks))
+
+  def _merge_done(self,
+                  in_flight: set[futures.Future],
+                  return_when: str,
+                  timeout: Optional[float] = None) -> None:
+    if not in_flight:
+      return
+    done, _ = futures.wait(in_flight, timeout=timeout, return_when=return_when)
+    for future in done:
+      in_flight.remove(future)
       try:
-        result.scores = self._score(result.image)
+        analyses = future.result()
       except Exception as ex:
-        self.config.log(f'  Error scoring {result.path.name} - {ex}')
-        return
+        self.config.log(f'  Error in worker - {ex}')
+        continue
+      self._merge_analyses(analyses)
+
+  def _merge_analyses(self, analyses: list[image_analyzer.Analysis]) -> None:
+    for analysis in analyses:
+      task = analysis.task
+      result = self.result_set.get_result(task.path.name)
+      for stage, error in analysis.errors.items():
+        self.config.log(f'  {error}: {task.path.name}')
+        metrics.increment('errors', stage=stage)
+      for stage, seconds in analysis.timings.items():
+        metrics.observe(stage, seconds)
+        run_profiler.record_file(stage, seconds, task.path)
+
+      if task.needs_centre and analysis.centre:
+        result.centre = analysis.centre
+      self.saliency_stats.add(analysis.saliency_timings,
+                              analysis.saliency_distances)
+      if analysis.lat_lon_extracted:
+        result.lat_lon = analysis.lat_lon
+        result.lat_lon_extracted = True
+      if task.needs_ocr and analysis.ocr_text is not None:
+        result.ocr_text = analysis.ocr_text
+        result.ocr_coverage = analysis.ocr_coverage
+        result.ocr_skipped = analysis.ocr_skipped
+      if task.needs_phash and analysis.phash:
+        result.phash = analysis.phash
+      if task.needs_scores and analysis.scores:
+        result.scores = analysis.scores
+        self.embedding_store.set(result.file_id, analysis.embedding)
+
+      self._update_result(result)
+
+  def _update_result(self, result: result_manager.Result) -> None:
+    if result.lat_lon:
+      result.location = self.geocoder.get_name(result.lat_lon)
+    self._update_total(result)
 
-    # Calculate the total
+  def _update_total(self, result: result_manager.Result) -> None:
+    # Calculate the total (once it's been scored)
+    if image_analyzer.LABEL_SET.difference(result.scores):
+      return
     weighted_score = [
-        round(LABEL_WEIGHTS[label] * result.scores[label], 3)
-        for label in LABELS
+        round(image_analyzer.LABEL_WEIGHTS[label] * result.scores[label], 3)
+        for label in image_analyzer.LABELS
     ]
     result.total = sum(weighted_score)
 
-  def _init_model(self) -> None:
-    model, _, preprocess = open_clip.create_model_and_transforms(
-        'ViT-B-32', pretrained='laion2b_s34b_b79k')
-    model.eval(
-    )  # model in train mode by default, impacts some models with BatchNorm or stochastic depth active
-    tokenizer = open_clip.get_tokenizer('ViT-B-32')
-
-    text = tokenizer(LABELS)
-    text_features = model.encode_text(text)
-    text_features /= text_features.norm(dim=-1, keepdim=True)
-
-    self._model = model
-    self._preprocess = preprocess
-    self._text_features = text_features
-
-  def _score(self, image: Image.Image) -> dict[str, float]:
-    # This is supposed to make things faster/more efficient but doesn't seem to do much;
-    # however, it does stop memory going crazy & getting the process killed after some time.
-    with torch.no_grad(), torch.cuda.amp.autocast():
-      processed_image = self._preprocess(image).unsqueeze(0)
-      image_features = self._model.encode_image(processed_image)
-      image_features /= image_features.norm(dim=-1, keepdim=True)
-      text_probs = (100.0 *
-                    image_features @ self._text_features.T).softmax(dim=-1)
-    return dict(zip(LABELS, text_probs.tolist()[0]))
-
-  def _get_centre(self,
-                  image_path: pathlib.Path) -> Optional[tuple[float, float]]:
-    # Load the image
-    image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-
-    # Create an ORB object
-    if self._orb is None:
-      self._orb = cv2.ORB_create()
-
-    # Detect key points and compute descriptors
-    key_points = self._orb.detect(image)
-
-    if key_points:
-      c_x = int(statistics.mean(kp.pt[0] for kp in key_points))
-      c_y = int(statistics.mean(kp.pt[1] for kp in key_points))
-      return (c_x, c_y)
-    else:
-      return None
+  def rescore(self) -> None:
+    # Re-score from the stored embeddings (e.g. after changing the labels or
+    # weights) without needing to load any images
+    self.config.log(f'Re-scoring {len(self.embedding_store)} embeddings...')
+    text_features = self.analyzer.encode_texts(image_analyzer.LABELS)
+    scores_by_file_id = self.embedding_store.score(image_analyzer.LABELS,
+                                                   text_features)
+    for file_id, scores in scores_by_file_id.items():
+      if result := self.result_set.results.get(file_id):
+        result.scores = scores
+        self._update_total(result)
+    self.result_set.save()
+    self.config.log('Re-scoring done!')
+
+  def rebuild_thumbnails(self) -> None:
+    self.thumbnails.rebuild([
+        result.path
+        for result in list(self.result_set.results.values())
+        if result.path
+    ])
 
   def find_groups(
       self,
@@ -270,57 +401,115 @@ class Scorer:
         self.result_set.results.values(),
         key=lambda result: result.taken or datetime.datetime.min,
     )
-    # Reset all groups
-    for result in results_list:
-      result.group_index = None
+    union_find = group_manager.UnionFind(len(results_list))
+
+    if self.config.group_mode in (GroupMode.TIME, GroupMode.BOTH):
+      # Group images taken shortly after the previous image
+      for index in range(1, len(results_list)):
+        result = results_list[index]
+        previous_result = results_list[index - 1]
+        if result.taken and previous_result.taken:
+          delta = result.taken - previous_result.taken
+          if delta <= maximum_delta:
+            union_find.union(index - 1, index)
+
+    index_by_file_id = {
+        result.file_id: index for index, result in enumerate(results_list)
+    }
+
+    if self.config.group_mode in (GroupMode.SIMILARITY, GroupMode.BOTH):
+      # Group images which look almost the same
+      file_ids, matrix = self.embedding_store.get_all()
+      pairs = group_manager.find_similar_pairs(matrix,
+                                               self.config.similarity_threshold)
+      for row_a, row_b in pairs:
+        index_a = index_by_file_id.get(file_ids[row_a])
+        index_b = index_by_file_id.get(file_ids[row_b])
+        if index_a is not None and index_b is not None:
+          union_find.union(index_a, index_b)
+      self.config.log(f'  Found {len(pairs)} similar pair(s)')
+
+    # Always group duplicates (however they're named)
+    self._hash_index = self._build_hash_index()
+    duplicate_pairs = self._hash_index.pairs()
+    for file_id_a, file_id_b in duplicate_pairs:
+      union_find.union(index_by_file_id[file_id_a], index_by_file_id[file_id_b])
+    self.config.log(f'  Found {len(duplicate_pairs)} duplicate pair(s)')
+
     groups = []
-    previous_result: result_manager.Result = results_list[0]
-    result: result_manager.Result
-    for result in results_list[1:]:
-      if result.taken and previous_result.taken:
-        delta = result.taken - previous_result.taken
-        if delta <= maximum_delta:
-          if previous_result.group_index is None:
-            groups.append([previous_result])
-            previous_result.group_index = len(groups)
-          groups[-1].append(result)
-          result.group_index = previous_result.group_index
-      previous_result = result
+    group_index_by_index = {}
+    for indexes in union_find.groups():
+      groups.append([results_list[index] for index in indexes])
+      for index in indexes:
+        group_index_by_index[index] = len(groups)
+    # Every result is assigned (ungrouped ones to None) without resetting them
+    # first, so results whose group hasn't changed aren't marked as changed
+    for index, result in enumerate(results_list):
+      result.group_index = group_index_by_index.get(index)
     self.config.log(f'Found {len(groups)} group(s)!')
     return groups
 
+  def _build_hash_index(self) -> group_manager.HashIndex:
+    # Read first so changes made while building cause another rebuild
+    generation = self.result_set.index.phash_generation
+    hash_index = group_manager.HashIndex(self.config.duplicate_distance)
+    for result in list(self.result_set.results.values()):
+      if result.phash:
+        hash_index.add(result.file_id, int(result.phash, 16))
+    self._hash_index_generation = generation
+    return hash_index
+
+  def get_duplicates(self, result: result_manager.Result) -> list[str]:
+    if not result.phash:
+      return []
+    # Rebuilt when any phash has changed (or results were added) since
+    if (self._hash_index is None or
+        self._hash_index_generation != self.result_set.index.phash_generation):
+      self._hash_index = self._build_hash_index()
+    duplicates = self._hash_index.query(int(result.phash, 16))
+    duplicates.discard(result.file_id)
+    return sorted(duplicates)
+
   def update_chosen(self) -> None:
-    results_list: list[result_manager.Result] = sorted(
-        self.result_set.results.values(),
-        key=lambda result:
-        (INCLUDE_OVERRIDE_ORDER[result.include_override], result.total),
+    columns = self.result_set.index.get_columns()
+    override_order = np.zeros(len(columns.results))
+    for include_override, order in INCLUDE_OVERRIDE_ORDER.items():
+      override_order[columns.include_override ==
+                     result_index.OVERRIDE_CODES[include_override]] = order
+    rows = result_index.argsort(
+        (override_order, columns.total),
+        np.arange(len(columns.results)),
         reverse=True,
     )
-    used_groups = []
+
+    is_included = columns.include_override == result_index.OVERRIDE_CODES[True]
+    is_excluded = np.logical_or.reduce((
+        # This image doesn't exist
+        ~columns.has_path,
+        # This image doesn't score enough
+        columns.total < self.config.minimum_score,
+        # Too much text
+        ((np.nan_to_num(columns.ocr_coverage)
+          >= self.config.ocr_coverage_threshold) &
+         (columns.ocr_text_length >= self.config.ocr_text_threshold)),
+        # This result has been specifically excluded
+        columns.include_override == result_index.OVERRIDE_CODES[False],
+    ))
+    candidates = is_included | ~is_excluded
+
+    used_groups = set()
     chosen_count = 0
-    for result in results_list:
-      if result.include_override != True and any((
-          # This image doesn't exist
-          result.path is None,
-          # This image doesn't score enough
-          result.total < self.config.minimum_score,
-          # This group has already been chosen already
-          result.group_index in used_groups,
-          # Too much text
-          all((
-              (result.ocr_coverage or 0) >= self.config.ocr_coverage_threshold,
-              len(result.ocr_text or '') >= self.config.ocr_text_threshold,
-          )),
-          # This result has been specifically excluded
-          result.include_override == False,
-      )):
+    for row in rows[candidates[rows]]:
+      result = columns.results[row]
+      # This group has already been chosen already
+      if result.include_override != True and result.group_index in used_groups:
         continue
 
       if chosen_count < self.config.output_count:
         result.is_chosen = True
         chosen_count += 1
       if result.is_chosen and result.group_index is not None:
-        used_groups.append(result.group_index)
+        used_groups.add(result.group_index)
     self.config.log(
         f'Chose {chosen_count} (/{self.config.output_count}) images')
 
@@ -329,7 +518,9 @@ class Scorer:
     # Find all files in the target folder
     self.config.output_dir.mkdir(parents=True, exist_ok=True)
     existing_path_by_file_id = {
-        file.name: file for file in self.config.output_dir.iterdir()
+        file.name: file
+        for file in self.config.output_dir.iterdir()
+        if not file.name.startswith(OUTPUT_INTERNAL_PREFIX)
     }
     existing_file_id_set = set(existing_path_by_file_id.keys())
 
@@ -342,11 +533,28 @@ class Scorer:
         (file_id for file_id, result in self.result_set.results.items()
          if result.is_chosen and result.needs_update))
 
+    # Outputs rendered with different inputs to what they'd be rendered with
+    # now (e.g. the crop size or font changed)
+    signatures = {
+        file_id: self._get_output_signature(file_id)
+        for file_id in chosen_file_id_set
+    }
+    stale_file_id_set = set()
+    if self.output_manifest.exists:
+      stale_file_id_set = set(
+          file_id for file_id in chosen_file_id_set & existing_file_id_set
+          if signatures[file_id] and
+          self.output_manifest.get(file_id) != signatures[file_id])
+    elif existing_file_id_set:
+      # Only needs_update can be trusted until the outputs are recorded
+      self.config.log('No output manifest; assuming existing files match')
+
     # Work out what files need to be added/removed
     file_ids_to_add_set = chosen_file_id_set - existing_file_id_set
     file_ids_to_add = list(sorted(file_ids_to_add_set))
     file_ids_to_update = list(
-        sorted(needs_update_file_id_set - file_ids_to_add_set))
+        sorted((needs_update_file_id_set | stale_file_id_set) -
+               file_ids_to_add_set))
     file_ids_to_remove = existing_file_id_set - chosen_file_id_set
     paths_to_remove = [
         existing_path_by_file_id[file_id] for file_id in file_ids_to_remove
@@ -357,10 +565,22 @@ class Scorer:
         file_ids_to_add=file_ids_to_add,
         file_ids_to_update=file_ids_to_update,
         paths_to_remove=paths_to_remove,
+        signatures=signatures,
+        stale_count=len(stale_file_id_set - needs_update_file_id_set),
     )
     self.config.log(f'Compare result: {compare_result}')
     return compare_result
 
+  def _get_output_signature(self, file_id: str) -> Optional[str]:
+    # Crops are cached by everything which affects their pixels, so their key
+    # is also the signature of the output
+    try:
+      image_format = crop_cache.get_format(self.config.output_dir / file_id)
+      return self.crop_cache.get_key(self.result_set.get_result(file_id),
+                                     image_format)
+    except Exception:
+      return None
+
   def update_files(self) -> None:
     compare_result = self.compare_files()
 
@@ -370,34 +590,131 @@ class Scorer:
     self.config.log(
         f'Removing {len(compare_result.paths_to_remove)} old files...')
     for index, path in enumerate(compare_result.paths_to_remove):
-      path.unlink()
+      with metrics.timer('output_remove'):
+        path.unlink()
       if index % 20 == 0:
         self.config.log(f'  Removed {index}...')
+    self.output_manifest.retain(compare_result.signatures)
+
+    # Files from before there was a manifest are taken to be up to date (as
+    # needs_update was all that was checked when they were written)
+    file_ids_to_write = set(compare_result.file_ids_to_add +
+                            compare_result.file_ids_to_update)
+    for file_id, signature in compare_result.signatures.items():
+      if (file_id not in file_ids_to_write and signature and
+          self.output_manifest.get(file_id) is None):
+        self.output_manifest.set(file_id, signature)
+
+    # Left behind by a previous update which didn't finish
+    for path in self.config.output_dir.glob(
+        f'{OUTPUT_INTERNAL_PREFIX}*{crop_cache.TEMP_SUFFIX}'):
+      path.unlink()
 
-    # Copy new files
-    self.config.log(
-        f'Copying {len(compare_result.file_ids_to_add)} new files...')
-    for index, file_id in enumerate(compare_result.file_ids_to_add):
-      result = self.result_set.get_result(file_id)
-      output_path = self.config.output_dir / file_id
-      cropped = result.get_cropped(self.config)
-      cropped.save(output_path, quality=self.config.output_quality)
-      result.needs_update = False
-      if index % 20 == 0:
-        self.config.log(f'  Copied {index}...')
-
-    # Update changed files
+    # Write new & changed files
     self.config.log(
-        f'Updating {len(compare_result.file_ids_to_update)} files...')
-    for index, file_id in enumerate(compare_result.file_ids_to_update):
-      result = self.result_set.get_result(file_id)
-      output_path = self.config.output_dir / file_id
-      output_path.unlink()
-      cropped = result.get_cropped(self.config)
-      cropped.save(output_path, quality=self.config.output_quality)
-      result.needs_update = False
-      if index % 20 == 0:
-        self.config.log(f'  Updated {index}...')
-
-    self.result_set.save()
+        f'Writing {len(compare_result.file_ids_to_add)} new & {len(compare_result.file_ids_to_update)} changed files...'
+    )
+    stats = self._write_outputs(compare_result.file_ids_to_add +
+                                compare_result.file_ids_to_update)
+    stats.output()
+    self.output_manifest.save()
     self.config.log('Updating done!')
+
+  def _write_outputs(self, file_ids: list[str]) -> OutputStats:
+    # Crops which aren't cached are rendered in worker processes (decoding,
+    # resizing & encoding are all CPU bound) and written as they finish.
+    # Results are only marked as updated (& saved) once their file is written.
+    stats = OutputStats(config=self.config, file_count=len(file_ids))
+    if not file_ids:
+      return stats
+
+    workers = max(self.config.render_workers, 1)
+    if workers > 1:
+      # Workers get a copy of the config which doesn't log through the server
+      worker_config = dataclasses.replace(self.config, log=print)
+      executor = futures.ProcessPoolExecutor(
+          max_workers=workers,
+          mp_context=multiprocessing.get_context('spawn'),
+          initializer=crop_cache.init_worker,
+          initargs=(worker_config,),
+      )
+      render_func = crop_cache.render_in_worker
+    else:
+      executor = futures.ThreadPoolExecutor(max_workers=1)
+      render_func = functools.partial(crop_cache.render, self.config)
+    in_flight: dict[futures.Future, tuple[result_manager.Result,
+                                          pathlib.Path]] = {}
+
+    with executor:
+      for file_id in file_ids:
+        if time.perf_counter() >= stats.next_time:
+          stats.output()
+          self._save_outputs(stats)
+
+        result = self.result_set.get_result(file_id)
+        try:
+          image_format = crop_cache.get_format(self.config.output_dir / file_id)
+          crop_path, cached = self.crop_cache.lookup(result, image_format)
+          if cached:
+            self._write_output(result, crop_path)
+            stats.succeed()
+            continue
+        except Exception as ex:
+          stats.fail(file_id, ex)
+          continue
+
+        # Keep enough work queued that workers never go idle, but not so much
+        # that finished crops wait around
+        if len(in_flight) >= 2 * workers:
+          self._merge_rendered(in_flight, futures.FIRST_COMPLETED, stats)
+        # Sent as a copy without the result set's index (which can't be sent
+        # to other processes)
+        future = executor.submit(render_func, dataclasses.replace(result),
+                                 image_format, crop_path)
+        in_flight[future] = (result, crop_path)
+
+      self._merge_rendered(in_flight, futures.ALL_COMPLETED, stats)
+    self._save_outputs(stats)
+    return stats
+
+  def _merge_rendered(
+      self,
+      in_flight: dict[futures.Future, tuple[result_manager.Result,
+                                            pathlib.Path]],
+      return_when: str,
+      stats: OutputStats,
+  ) -> None:
+    done, _ = futures.wait(in_flight, return_when=return_when)
+    for future in done:
+      result, crop_path = in_flight.pop(future)
+      try:
+        seconds = future.result()
+        metrics.observe('output_crop', seconds)
+        run_profiler.record_file('output_crop', seconds, result.path)
+        self.crop_cache.add(crop_path)
+        self._write_output(result, crop_path)
+      except Exception as ex:
+        stats.fail(result.file_id, ex)
+        continue
+      stats.succeed()
+
+  def _write_output(self, result: result_manager.Result,
+                    crop_path: pathlib.Path) -> None:
+    # Copied to a temp file & renamed, so the mirror never reads a half written
+    # image (& a failed update leaves the previous image in place)
+    output_path = self.config.output_dir / result.file_id
+    temp_path = output_path.with_name(
+        f'{OUTPUT_INTERNAL_PREFIX}_{output_path.name}{crop_cache.TEMP_SUFFIX}')
+    with metrics.timer('output_write'):
+      shutil.copyfile(crop_path, temp_path)
+      os.replace(temp_path, output_path)
+    result.needs_update = False
+    # Crops are named by their key, which is the output's signature
+    self.output_manifest.set(result.file_id, crop_path.stem)
+
+  def _save_outputs(self, stats: OutputStats) -> None:
+    if stats.unsaved:
+      with metrics.timer('save'):
+        self.result_set.save()
+        self.output_manifest.save()
+      stats.unsaved = 0
@@ -4,16 +4,22 @@ from dataclasses import field
 import datetime
 from enum import Enum
 from http import client
-from io import BytesIO
 import math
 import os
 from typing import Callable, Optional
 
 import flask
+import numpy as np
 import pydantic
 
+from src import crop_cache
+from src import metrics
+from src import result_index
 from src import result_manager
+from src import run_profiler
+from src import save_manager
 from src import score_processor
+from src import thumbnail_manager
 from src.config import Config
 
 # TODO (functionality):
@@ -57,6 +63,9 @@ from src.config import Config
 #   - Generate cropped for all images (optionally use in grid?)
 #   - Track tasks through db
 
+# Seconds browsers can keep versioned images for
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
 INCLUDE_OVERRIDE_VALUES = {
     'true': True,
     'false': False,
@@ -83,12 +92,17 @@ class SortType(Enum):
   TOTAL = 'total'
 
 
-SORT_KEYS = {
-    SortType.OCR_COVERAGE:
-        (lambda r: (r.ocr_coverage or 0, r.taken or datetime.datetime.min)),
-    SortType.TAKEN: lambda r: r.taken or datetime.datetime.min,
-    SortType.TOTAL: lambda r: (r.total or 0, r.taken or datetime.datetime.min),
-}
+# Columns to sort by (most significant first)
+SORT_KEYS: dict[SortType,
+                Callable[[result_index.Columns], tuple[np.ndarray, ...]]] = {
+                    SortType.OCR_COVERAGE: lambda c:
+                                           (np.nan_to_num(c.ocr_coverage),
+                                            result_index.get_taken_order(c)),
+                    SortType.TAKEN: lambda c:
+                                    (result_index.get_taken_order(c),),
+                    SortType.TOTAL: lambda c:
+                                    (c.total, result_index.get_taken_order(c)),
+                }
 
 
 class GridSettings(pydantic.BaseModel):
@@ -123,13 +137,16 @@ class GridSettings(pydantic.BaseModel):
   sort_type: SortType = SortType.TAKEN
   sort_reverse: bool = True
 
-  def get_matcher(self) -> Callable[[result_manager.Result], bool]:
+  def get_rows(self, columns: result_index.Columns) -> np.ndarray:
+    mask = np.ones(len(columns.results), dtype=bool)
     # - Chosen
     chosen_values = []
     if self.chosen_yes:
       chosen_values.append(True)
     if self.chosen_no:
       chosen_values.append(False)
+    if chosen_values:
+      mask &= np.isin(columns.is_chosen, chosen_values)
     # - Override
     override_values = []
     if self.override_include:
@@ -138,35 +155,55 @@ class GridSettings(pydantic.BaseModel):
       override_values.append(False)
     if self.override_unset:
       override_values.append(None)
-    # - Location
+    if override_values:
+      mask &= np.isin(
+          columns.include_override,
+          [result_index.OVERRIDE_CODES[value] for value in override_values],
+      )
+    # - Date (images without one always match)
+    date_from = result_index.to_seconds(
+        datetime.datetime.combine(self.date_from, datetime.time.min))
+    date_to = result_index.to_seconds(
+        datetime.datetime.combine(self.date_to, datetime.time.max))
+    mask &= (np.isnan(columns.taken) | ((columns.taken >= date_from) &
+                                        (columns.taken <= date_to)))
+    # - Score
+    mask &= (columns.total >= self.score_from) & (columns.total
+                                                  <= self.score_to)
+    # - Bounds
+    if self.north or self.south or self.east or self.west:
+      mask &= ~np.isnan(columns.lat)
+      if self.north is not None:
+        mask &= columns.lat <= self.north
+      if self.south is not None:
+        mask &= columns.lat >= self.south
+      if self.east is not None:
+        mask &= columns.lon <= self.east
+      if self.west is not None:
+        mask &= columns.lon >= self.west
+    # - OCR coverage
+    ocr_coverage = np.nan_to_num(columns.ocr_coverage)
+    if self.ocr_coverage_from is not None:
+      mask &= ocr_coverage >= self.ocr_coverage_from
+    if self.ocr_coverage_to is not None:
+      mask &= ocr_coverage <= self.ocr_coverage_to
+    rows = np.flatnonzero(mask)
+
+    # Text isn't indexed, so only check it for rows which matched everything else
     location_name = self.location_name.lower() if self.location_name else None
-    has_bounds = bool(self.north or self.south or self.east or self.west)
-    # - OCR text
     ocr_text_lower = self.ocr_text.lower() if self.ocr_text else None
+    if location_name or ocr_text_lower:
 
-    def matcher(result: result_manager.Result) -> bool:
-      return all((
-          not chosen_values or result.is_chosen in chosen_values,
-          not override_values or result.include_override in override_values,
-          (not result.taken or
-           self.date_from <= result.taken.date() <= self.date_to),
-          result.total >= self.score_from and result.total <= self.score_to,
-          not location_name or location_name in (result.location or '').lower(),
-          not has_bounds or (result.lat_lon and all((
-              self.north is None or self.north >= result.lat_lon.lat,
-              self.south is None or self.south <= result.lat_lon.lat,
-              self.east is None or self.east >= result.lat_lon.lon,
-              self.west is None or self.west <= result.lat_lon.lon,
-          ))),
-          (self.ocr_coverage_from is None or
-           (result.ocr_coverage or 0) >= self.ocr_coverage_from),
-          (self.ocr_coverage_to is None or
-           (result.ocr_coverage or 0) <= self.ocr_coverage_to),
-          (not ocr_text_lower or
-           ocr_text_lower in (result.ocr_text or '').lower()),
-      ))
-
-    return matcher
+      def matches_text(result: result_manager.Result) -> bool:
+        return all((
+            not location_name or
+            location_name in (result.location or '').lower(),
+            (not ocr_text_lower or
+             ocr_text_lower in (result.ocr_text or '').lower()),
+        ))
+
+      rows = rows[[matches_text(columns.results[row]) for row in rows]]
+    return rows
 
 
 @dataclass
@@ -197,12 +234,48 @@ class ConfigLogger:
     }
 
 
-def send_cropped(result: result_manager.Result, config: Config) -> flask.Response:
-  img_bytes = result.get_cropped_bytes(config)
-  img_io = BytesIO()
-  img_io.write(img_bytes)
-  img_io.seek(0)
-  return flask.send_file(img_io, mimetype='image/jpeg', max_age=0)
+def send_conditional(
+    etag: str,
+    get_response: Callable[[], flask.Response],
+) -> flask.Response:
+  # If-None-Match is checked before get_response is called, so unchanged images
+  # aren't read, decoded or rendered at all
+  if flask.request.if_none_match.contains(etag):
+    response = flask.Response(status=client.NOT_MODIFIED)
+  else:
+    response = get_response()
+  response.set_etag(etag)
+  if flask.request.args.get('v') == etag:
+    # Versioned URLs change whenever the image does, so can be kept forever
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = IMMUTABLE_MAX_AGE
+    response.cache_control.immutable = True
+  else:
+    # Can be cached, but must be checked with the ETag before being used
+    response.cache_control.max_age = None
+    response.cache_control.no_cache = True
+  return response
+
+
+def send_cropped(result: result_manager.Result,
+                 scorer: score_processor.Scorer) -> flask.Response:
+  return send_conditional(
+      scorer.crop_cache.get_key(result, crop_cache.SERVE_FORMAT),
+      lambda: flask.send_file(
+          scorer.crop_cache.get_path(result),
+          mimetype='image/jpeg',
+          etag=False,
+      ),
+  )
+
+
+def get_source_version(result: result_manager.Result) -> str:
+  # Used in image URLs; matches the ETag of the image & its thumbnails
+  try:
+    return result_manager.get_source_key(result.path) if result.path else ''
+  except OSError:
+    return ''
 
 
 def serve(
@@ -217,31 +290,51 @@ def serve(
   config_logger = ConfigLogger()
   config.log = config_logger.add_log
 
+  # Edits are saved in the background, so a burst of them is a single write
+  saver = save_manager.BackgroundSaver(config,
+                                       (result_set.save, scorer.geocoder.save))
+
   ACTION_FUNCS = {
       'process': scorer.process,
+      'rescore': scorer.rescore,
       'check': scorer.compare_files,
       'apply': scorer.update_files,
-      'save': result_set.save,
+      'save': saver.flush,
+      'thumbnails': scorer.rebuild_thumbnails,
   }
 
   action_executor = ThreadPoolExecutor(max_workers=1)
 
+  def get_crop_version(result: result_manager.Result) -> str:
+    # Used in crop URLs; matches the crop's ETag
+    try:
+      return scorer.crop_cache.get_key(
+          result, crop_cache.SERVE_FORMAT) if result.path else ''
+    except OSError:
+      return ''
+
+  app.jinja_env.globals.update(
+      source_version=get_source_version,
+      crop_version=get_crop_version,
+  )
+
   @app.route('/', methods=('GET', 'POST'))
   def index():
-    result: result_manager.Result
-    count_chosen = len(
-        [result for result in result_set.results.values() if result.is_chosen])
-
+    columns = result_set.index.get_columns()
     return flask.render_template(
         'index.tpl',
-        count_total=len(result_set.results),
-        count_chosen=count_chosen,
+        count_total=len(columns.results),
+        count_chosen=int(columns.is_chosen.sum()),
     )
 
-  def _process_action(action: str) -> None:
+  def _process_action(action: str, profile: bool) -> None:
     if action_func := ACTION_FUNCS.get(action):
       try:
-        action_func()
+        if profile:
+          with run_profiler.Profile(config, action):
+            action_func()
+        else:
+          action_func()
       except Exception as ex:
         config.log(f'Error running action {action}: {ex}')
     else:
@@ -251,39 +344,32 @@ def serve(
   def processing():
     if flask.request.method == 'POST':
       action = flask.request.form.get('action')
-      action_executor.submit(_process_action, action)
-
-    total_counts = Counts()
-    group_indexes = set()
-    grouped_counts = Counts()
-    ungrouped_counts = Counts()
-    score_counts = {}
-    result: result_manager.Result
-    for result in result_set.results.values():
-      total = round(result.total)
-      if total not in score_counts:
-        score_counts[total] = Counts()
-
-      score_counts[total].total += 1
-      total_counts.total += 1
-      if result.is_chosen:
-        score_counts[total].chosen += 1
-        total_counts.chosen += 1
-
-      if result.group_index is None:
-        ungrouped_counts.total += 1
-        if result.is_chosen:
-          ungrouped_counts.chosen += 1
-      else:
-        group_indexes.add(result.group_index)
-        grouped_counts.total += 1
-        if result.is_chosen:
-          grouped_counts.chosen += 1
+      profile = flask.request.form.get('profile') == 'true'
+      action_executor.submit(_process_action, action, profile)
+
+    columns = result_set.index.get_columns()
+
+    def _get_counts(mask: np.ndarray) -> Counts:
+      return Counts(
+          total=int(mask.sum()),
+          chosen=int((mask & columns.is_chosen).sum()),
+      )
+
+    is_grouped = columns.group_index != result_index.NO_GROUP
+    total_counts = _get_counts(np.ones(len(columns.results), dtype=bool))
+    grouped_counts = _get_counts(is_grouped)
+    ungrouped_counts = _get_counts(~is_grouped)
+    # Rounds halves to even, like round()
+    rounded_totals = np.round(columns.total).astype(np.int64)
+    score_counts = {
+        int(total): _get_counts(rounded_totals == total)
+        for total in np.unique(rounded_totals)
+    }
 
     return flask.render_template(
         'processing.tpl',
         total_counts=total_counts,
-        group_count=len(group_indexes),
+        group_count=len(np.unique(columns.group_index[is_grouped])),
         grouped_counts=grouped_counts,
         ungrouped_counts=ungrouped_counts,
         score_counts=score_counts,
@@ -298,42 +384,41 @@ def serve(
     settings = GridSettings(**args_with_values)
 
     # Work out date bounds & validate
-    results = result_set.results.values()
+    columns = result_set.index.get_columns()
     date_min = datetime.date.max
     date_max = datetime.date.min
-    for result in results:
-      if result.taken:
-        result_date = result.taken.date()
-        date_min = min(date_min, result_date)
-        date_max = max(date_max, result_date)
+    if not np.isnan(columns.taken).all():
+      date_min = result_index.get_date(np.nanmin(columns.taken))
+      date_max = result_index.get_date(np.nanmax(columns.taken))
     settings.date_from = min(max(settings.date_from, date_min), date_max)
     settings.date_to = min(max(settings.date_to, date_min), date_max)
 
     # Apply filters
-    results = list(filter(settings.get_matcher(), results))
+    rows = settings.get_rows(columns)
 
     # Validate Page index
-    filtered_results = len(results)
+    filtered_results = len(rows)
     total_pages = math.ceil(filtered_results / settings.page_size)
     settings.page_index = max(min(settings.page_index, total_pages - 1), 0)
 
     # Sort
-    results.sort(
-        key=SORT_KEYS[settings.sort_type],
+    rows = result_index.argsort(
+        SORT_KEYS[settings.sort_type](columns),
+        rows,
         reverse=settings.sort_reverse,
     )
 
     # Paginate results
     start_index = settings.page_index * settings.page_size
     end_index = start_index + settings.page_size
-    page = results[start_index:end_index]
+    page = [columns.results[row] for row in rows[start_index:end_index]]
 
     return flask.render_template(
         'grid.tpl',
         settings=settings,
         date_min=date_min,
         date_max=date_max,
-        total_results=len(result_set.results),
+        total_results=len(columns.results),
         filtered_results=filtered_results,
         total_pages=total_pages,
         page=page,
@@ -354,34 +439,36 @@ def serve(
           result.update_description(description)
         else:
           raise Exception(f'Unknown action: {action}')
-        action_executor.submit(_process_action, 'save')
+        saver.request()
       return flask.render_template(
           'result.tpl',
           title=result.file_id,
           results=[result],
+          duplicates={result.file_id: scorer.get_duplicates(result)},
       )
     else:
       return flask.abort(client.NOT_FOUND)
 
-  @app.route('/api/result/centre/<file_id>', methods=('POST', ))
+  @app.route('/api/result/centre/<file_id>', methods=('POST',))
   def api_result_centre(file_id: str):
     result = result_set.results.get(file_id)
     if result:
       # Update centre & save
       result.centre = (flask.request.json['x'], flask.request.json['y'])
       result.needs_update = True
-      result_set.save()
+      saver.request()
 
       # Return image bytes
-      return send_cropped(result, config)
+      return send_cropped(result, scorer)
     else:
       return flask.abort(client.NOT_FOUND)
 
   @app.route('/group/<int:group_index>', methods=('GET', 'POST'))
   def group_handler(group_index: int):
+    columns = result_set.index.get_columns()
     results = [
-        result for result in result_set.results.values()
-        if result.group_index == group_index
+        columns.results[row]
+        for row in np.flatnonzero(columns.group_index == group_index)
     ]
     if results:
       if flask.request.method == 'POST':
@@ -401,11 +488,14 @@ def serve(
             result.update_description(description)
         else:
           raise Exception(f'Unknown action: {action}')
-        action_executor.submit(_process_action, 'save')
+        saver.request()
       return flask.render_template(
           'result.tpl',
           title=f'Group {group_index}',
           results=results,
+          duplicates={
+              result.file_id: scorer.get_duplicates(result) for result in results
+          },
       )
     else:
       return flask.abort(client.NOT_FOUND)
@@ -414,15 +504,39 @@ def serve(
   def image_handler(file_id: str):
     result = result_set.results.get(file_id)
     if result and result.path:
-      return flask.send_file(result.path, max_age=600)
+      return send_conditional(
+          result_manager.get_source_key(result.path),
+          lambda: flask.send_file(result.path, etag=False),
+      )
     else:
       return flask.abort(client.NOT_FOUND)
 
+  @app.route('/image/thumbnail/<size_name>/<file_id>')
+  def image_thumbnail_handler(size_name: str, file_id: str):
+    result = result_set.results.get(file_id)
+    if not result or not result.path or (size_name
+                                         not in thumbnail_manager.SIZES):
+      return flask.abort(client.NOT_FOUND)
+
+    def _send_thumbnail() -> flask.Response:
+      try:
+        path = scorer.thumbnails.get(result.path, size_name)
+      except Exception as ex:
+        config.log(f'Error getting thumbnail for {file_id}: {ex}')
+        return flask.abort(client.NOT_FOUND)
+      return flask.send_file(path,
+                             mimetype=thumbnail_manager.MIMETYPE,
+                             etag=False)
+
+    # Thumbnails only change when the original does
+    return send_conditional(result_manager.get_source_key(result.path),
+                            _send_thumbnail)
+
   @app.route('/image/cropped/<file_id>')
   def image_cropped_handler(file_id: str):
     result = result_set.results.get(file_id)
     if result and result.path:
-      return send_cropped(result, config)
+      return send_cropped(result, scorer)
     else:
       return flask.abort(client.NOT_FOUND)
 
@@ -431,6 +545,13 @@ def serve(
     logs = config_logger.get_logs(min_index)
     return flask.jsonify(logs)
 
+  @app.route('/metrics')
+  def metrics_handler():
+    return flask.Response(
+        metrics.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8',
+    )
+
   @app.route('/map')
   def map():
     return flask.render_template('map.tpl',
@@ -439,21 +560,25 @@ def serve(
 
   @app.route('/api/map/points')
   def map_points():
-    result: result_manager.Result
-    points = [{
-        'type': 'Feature',
-        'properties': {
-            'file_id': result.file_id,
-            'group_index': result.group_index,
-            'is_chosen': result.is_chosen,
-            'location': result.location,
-            'time_taken_text': result.get_time_taken_text(config),
-        },
-        'geometry': {
-            'type': 'Point',
-            'coordinates': [result.lat_lon.lon, result.lat_lon.lat],
-        }
-    } for result in result_set.results.values() if result.lat_lon]
+    columns = result_set.index.get_columns()
+    points = []
+    for row in np.flatnonzero(~np.isnan(columns.lat)):
+      result = columns.results[row]
+      points.append({
+          'type': 'Feature',
+          'properties': {
+              'file_id': result.file_id,
+              'group_index': result.group_index,
+              'is_chosen': result.is_chosen,
+              'location': result.location,
+              'time_taken_text': result.get_time_taken_text(config),
+          },
+          'geometry': {
+              'type': 'Point',
+              'coordinates': [float(columns.lon[row]),
+                              float(columns.lat[row])],
+          }
+      })
 
     return flask.jsonify({'points': points})
 
@@ -33,7 +33,7 @@ document.addEventListener('DOMContentLoaded', () => {
         <p>
           <a href="${link}" target="_blank">
             <div class="image-thumbnail">
-              <img src="/image/${props.file_id}"/>
+              <img src="/image/thumbnail/small/${props.file_id}"/>
             </div>
             ${text}
           </a>
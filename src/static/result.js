@@ -8,10 +8,11 @@ document.addEventListener('DOMContentLoaded', () => {
       centreable.appendChild(marker);
 
       const updateMarkerFromData = () => {
-          // Calculate the scale ratio
+          // Calculate the scale ratio (the centre is in original image pixels,
+          // but a smaller thumbnail is displayed)
           const rect = img.getBoundingClientRect();
-          const scaleX = rect.width / img.naturalWidth;
-          const scaleY = rect.height / img.naturalHeight;
+          const scaleX = rect.width / parseFloat(img.dataset.originalWidth);
+          const scaleY = rect.height / parseFloat(img.dataset.originalHeight);
 
           // Set position relative to the displayed size
           marker.style.left = (img.offsetLeft + parseFloat(img.dataset.centreX) * scaleX) + "px";
@@ -25,9 +26,9 @@ document.addEventListener('DOMContentLoaded', () => {
           const clickX = e.clientX - rect.left;
           const clickY = e.clientY - rect.top;
 
-          // Convert back to "Natural" pixels for storage
-          const newNatX = Math.round(clickX * (img.naturalWidth / rect.width));
-          const newNatY = Math.round(clickY * (img.naturalHeight / rect.height));
+          // Convert back to original image pixels for storage
+          const newNatX = Math.round(clickX * (parseFloat(img.dataset.originalWidth) / rect.width));
+          const newNatY = Math.round(clickY * (parseFloat(img.dataset.originalHeight) / rect.height));
 
           // Update Data Attributes & marker
           img.setAttribute('data-centre-x', newNatX);
@@ -43,9 +44,15 @@ document.addEventListener('DOMContentLoaded', () => {
                   body: JSON.stringify({ x: newNatX, y: newNatY })
               });
               if (response.ok) {
-                  // Assuming the API returns the image as a blob
-                  const blob = await response.blob();
-                  targetCropImg.src = URL.createObjectURL(blob);
+                  // The ETag is the new crop's version, so point at its versioned
+                  // (cacheable) URL, which the server has just rendered
+                  const version = (response.headers.get('ETag') || '').replaceAll('"', '');
+                  const cropUrl = `/image/cropped/${imageId}?v=${version}`;
+                  targetCropImg.src = cropUrl;
+                  const link = targetCropImg.closest('a');
+                  if (link) {
+                      link.href = cropUrl;
+                  }
               }
           } catch (error) {
               console.error("API Error:", error);
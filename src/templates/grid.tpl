@@ -249,7 +249,7 @@
           {% endif %}
           >
           <div class="image-thumbnail" title="{{ result.file_id }}">
-            <img src="/image/{{ result.file_id }}"/>
+            <img src="/image/thumbnail/small/{{ result.file_id }}?v={{ source_version(result) }}" loading="lazy"/>
           </div>
           {% if result.group_index %}
             <span class="group-text">{{ result.group_index }}</span>
@@ -63,12 +63,22 @@
     <button type="submit" name="action" value="process">
       Process Files
     </button>
+    <button type="submit" name="action" value="rescore">
+      Re-score Files
+    </button>
     <button type="submit" name="action" value="check">
       Check file updates
     </button>
     <button type="submit" name="action" value="apply">
       Apply file updates
     </button>
+    <button type="submit" name="action" value="thumbnails">
+      Rebuild thumbnails
+    </button>
+    <label>
+      <input type="checkbox" name="profile" value="true">
+      Profile
+    </label>
   </form>
   <table border="1" id="logs-table">
     <thead>
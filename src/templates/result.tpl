@@ -30,20 +30,24 @@
       <tr class="{% if result.is_chosen %}chosen{% endif %} {% if result.include_override == False %}exclude{% endif %}">
         <td>
           <span class="grid">
+            {% set original_size = result.get_original_size() if result.path else (0, 0) %}
             <div class="image-thumbnail large centreable" title="{{ result.file_id }}">
-              <img src="/image/{{ result.file_id }}"
+              <img src="/image/thumbnail/medium/{{ result.file_id }}?v={{ source_version(result) }}"
                 data-id="{{ result.file_id }}"
                 data-centre-x="{{ result.centre[0] }}"
                 data-centre-y="{{ result.centre[1] }}"
+                data-original-width="{{ original_size[0] }}"
+                data-original-height="{{ original_size[1] }}"
               />
             </div>
           </span>
         </td>
         <td>
           <span class="grid">
-            <a target="_blank" href="/image/cropped/{{ result.file_id }}">
+            {% set crop_url = '/image/cropped/' ~ result.file_id ~ '?v=' ~ crop_version(result) %}
+            <a target="_blank" href="{{ crop_url }}">
               <div class="image-thumbnail large" title="{{ result.file_id }}">
-                <img src="/image/cropped/{{ result.file_id }}"
+                <img src="{{ crop_url }}"
                   class="centreable-cropped"
                   data-id="{{ result.file_id }}"
                 />
@@ -90,6 +94,18 @@
                 {% endif %}
               </td>
             </tr>
+            <tr>
+              <th>Duplicates</th>
+              <td>
+                {% for duplicate_file_id in duplicates[result.file_id] %}
+                  <a target="_blank" href="/result/{{ duplicate_file_id }}">
+                    {{ duplicate_file_id }}
+                  </a><br/>
+                {% else %}
+                  -
+                {% endfor %}
+              </td>
+            </tr>
             <tr>
               <th>Description</th>
               <td>
@@ -0,0 +1,144 @@
+from concurrent.futures import ThreadPoolExecutor
+import math
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+from typing import Optional
+
+from PIL import features
+from PIL import Image
+from PIL import ImageOps
+
+from src import metrics
+from src import result_manager
+from src.config import Config
+
+# Longest side of each size
+SIZES = {
+    'small': 320,
+    'medium': 1280,
+}
+MAX_SIZE = max(SIZES.values())
+
+# WebP is much smaller, but Pillow may have been built without it
+if features.check('webp'):
+  FORMAT = 'WEBP'
+  EXTENSION = 'webp'
+  MIMETYPE = 'image/webp'
+else:
+  FORMAT = 'JPEG'
+  EXTENSION = 'jpg'
+  MIMETYPE = 'image/jpeg'
+QUALITY = 80
+# WebP encoder effort (0-6); 2 is several times quicker than the default of 4
+# for barely bigger files
+WEBP_METHOD = 2
+
+
+def _fit_longest(image: Image.Image, size: int) -> Image.Image:
+  if max(image.size) <= size:
+    return image
+  return ImageOps.contain(image, (size, size), Image.Resampling.BICUBIC)
+
+
+def _decode(path: pathlib.Path) -> Image.Image:
+  with Image.open(path) as image:
+    # Let the JPEG decoder do (much cheaper) DCT scaling down to the largest
+    # size
+    scale = MAX_SIZE / max(image.size)
+    if scale < 1:
+      image.draft(
+          'RGB',
+          (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+    return ImageOps.exif_transpose(image)
+
+
+class ThumbnailStore:
+  # Reduced size copies of images for the UI (so pages don't load the originals)
+  # stored in cache_dir/thumbnails/<size>/<shard>/<key>, where the key is the
+  # source file's key
+
+  def __init__(self, config: Config):
+    self.config = config
+    self.directory = config.cache_dir / 'thumbnails'
+    # Only created when something is queued (worker processes never need it)
+    self._executor: Optional[ThreadPoolExecutor] = None
+    self._queued: set[pathlib.Path] = set()
+    self._lock = threading.Lock()
+
+  def get_path(self, path: pathlib.Path, size_name: str) -> pathlib.Path:
+    key = result_manager.get_source_key(path)
+    # Sharded so no directory gets too big to list
+    return self.directory / size_name / key[:2] / f'{key}.{EXTENSION}'
+
+  def has(self, path: pathlib.Path) -> bool:
+    return all(self.get_path(path, size_name).exists() for size_name in SIZES)
+
+  def get(self, path: pathlib.Path, size_name: str) -> pathlib.Path:
+    # Builds the thumbnails now if they haven't been built yet
+    if size_name not in SIZES:
+      raise Exception(f'Unknown thumbnail size: {size_name}')
+    thumbnail_path = self.get_path(path, size_name)
+    if thumbnail_path.exists():
+      metrics.increment('thumbnails', status='hit')
+    else:
+      metrics.increment('thumbnails', status='miss')
+      with metrics.timer('thumbnails'):
+        self.build(path)
+    return thumbnail_path
+
+  def build(self,
+            path: pathlib.Path,
+            image: Optional[Image.Image] = None) -> None:
+    # image can be an already decoded copy, as long as it's at least MAX_SIZE
+    # (or the original size)
+    if image is None:
+      image = _decode(path)
+    if image.mode not in ('RGB', 'L'):
+      image = image.convert('RGB')
+    # Largest first, so each is resized from the previous (smaller) one
+    for size_name, size in sorted(SIZES.items(),
+                                  key=lambda item: item[1],
+                                  reverse=True):
+      image = _fit_longest(image, size)
+      self._save(image, self.get_path(path, size_name))
+
+  def _save(self, image: Image.Image, thumbnail_path: pathlib.Path) -> None:
+    thumbnail_path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=thumbnail_path.parent,
+                                     suffix='.tmp',
+                                     delete=False) as temp_file:
+      image.save(temp_file, FORMAT, quality=QUALITY, method=WEBP_METHOD)
+    os.replace(temp_file.name, thumbnail_path)
+
+  def queue(self, path: pathlib.Path) -> None:
+    # Builds the thumbnails in the background
+    with self._lock:
+      if path in self._queued:
+        return
+      self._queued.add(path)
+      if self._executor is None:
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.config.thumbnail_threads,
+            thread_name_prefix='thumbnails',
+        )
+      self._executor.submit(self._build_queued, path)
+
+  def _build_queued(self, path: pathlib.Path) -> None:
+    try:
+      if not self.has(path):
+        with metrics.timer('thumbnails'):
+          self.build(path)
+    except Exception as ex:
+      self.config.log(f'  Error building thumbnails for {path.name} - {ex}')
+    finally:
+      with self._lock:
+        self._queued.discard(path)
+
+  def rebuild(self, paths: list[pathlib.Path]) -> None:
+    self.config.log(f'Rebuilding thumbnails for {len(paths)} images...')
+    shutil.rmtree(self.directory, ignore_errors=True)
+    for path in paths:
+      self.queue(path)